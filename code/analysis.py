@@ -2,6 +2,8 @@
 This file containts different functions used in the analysis section
 for modifying datasets and generating figures
 """
+import os, time, hashlib
+from concurrent.futures import ProcessPoolExecutor
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
     # this avoids a warning when using the replace command
@@ -11,9 +13,17 @@ import plotly.express as px
 import plotly.io as pio
 pio.templates.default = "seaborn"
 import statsmodels.formula.api as sm
+from scipy import linalg, stats
 from scipy.stats import gaussian_kde
+import instrument
 #from sklearn.linear_model import LinearRegression
 
+outcomes = ['Exports_Ratio','Imports_Ratio']
+join_dummies = ['Five_Years_After', 'Ten_Years_After', 'EU_Member', 'Three_Years_Around']
+reg_cache_dir = '../temp/reg_cache/'
+reg_cache = {}
+    # fitted results by (data hash, outcome, join dummy, controls)
+
 # Run regressions
 def reg_stats(y_var,x_var,industry,df_ols):
     controls = df_ols.columns[7:]
@@ -24,17 +34,129 @@ def reg_stats(y_var,x_var,industry,df_ols):
     return pd.DataFrame({'Trade Type':[y_var.split('_')[0]], 'Join_Dummy':[x_var], 'Industry':[industry],
                          'Coefficient':[res.params[x_var]], 'p-Value':[res.pvalues[x_var]]})
 
-def all_reg_stats(df_ols,significance=1):
-    reg_results_stats = pd.DataFrame(columns=['Trade Type','Industry','Join_Dummy', 'Coefficient', 'p-Value'])
-    for y_var in ['Exports_Ratio','Imports_Ratio']:
-        for industry in pd.unique(df_ols['Industry']):
-            for x_var in ['Five_Years_After', 'Ten_Years_After', 'EU_Member', 'Three_Years_Around']:
-                try:
-                    reg_results_stats = pd.concat([reg_results_stats, reg_stats(y_var,x_var,industry,df_ols)],ignore_index=True)
-                except: # in case there is no variation for the JoinDummy in the industry sample
-                    pass
+def all_reg_stats(df_ols,significance=1,engine='statsmodels',controls=None,max_workers=None):
+    with instrument.stage('all_reg_stats', engine=engine) as record:
+        record['rows'] = len(df_ols)
+        if engine == 'batched':
+            reg_results_stats = batched_reg_stats(df_ols,controls)
+        elif engine == 'parallel':
+            reg_results_stats = cached_reg_stats(df_ols,controls,max_workers)
+                # a call that only changes the significance level re-uses the fitted results
+        else:
+            reg_results_stats = pd.DataFrame(columns=['Trade Type','Industry','Join_Dummy', 'Coefficient', 'p-Value'])
+            for y_var in outcomes:
+                for industry in pd.unique(df_ols['Industry']):
+                    with instrument.stage('industry regressions', industry=industry, outcome=y_var):
+                        for x_var in join_dummies:
+                            try:
+                                reg_results_stats = pd.concat([reg_results_stats, reg_stats(y_var,x_var,industry,df_ols)],ignore_index=True)
+                            except: # in case there is no variation for the JoinDummy in the industry sample
+                                pass
     return reg_results_stats[reg_results_stats['p-Value']<significance].pivot(index=['Trade Type','Industry'], columns='Join_Dummy', values='Coefficient')
 
+# Run all regressions of one industry at once:
+# by Frisch-Waugh-Lovell, the coefficient of a join dummy follows from regressing the outcome on the dummy
+# after both are residualized on the controls, so the controls only have to be factorized once per industry
+def control_basis(controls):
+    # orthonormal basis of [constant, controls], dropping collinear controls (pivoted QR)
+    design = np.column_stack([np.ones(len(controls)), controls])
+    q, r, _ = linalg.qr(design, mode='economic', pivoting=True)
+    diagonal = np.abs(np.diag(r))
+    rank = int((diagonal > diagonal[0] * max(design.shape) * np.finfo(float).eps).sum())
+    return q[:, :rank]
+
+def fwl_stats(basis,dummies,outcomes,rank_tol=1e-10):
+    # coefficient, standard error and p-value for every dummy (rows) and outcome (columns)
+    dummies_res = dummies - basis @ (basis.T @ dummies)
+    outcomes_res = outcomes - basis @ (basis.T @ outcomes)
+    ssr_dummies = (dummies_res**2).sum(axis=0)
+    identified = ssr_dummies > rank_tol * (dummies**2).sum(axis=0)
+        # a dummy without variation (or collinear with the controls) has no coefficient
+    ssr_dummies = np.where(identified, ssr_dummies, np.nan)
+    coefficients = (dummies_res.T @ outcomes_res) / ssr_dummies[:, None]
+    df_resid = len(dummies) - basis.shape[1] - 1
+    ssr = (outcomes_res**2).sum(axis=0)[None, :] - coefficients**2 * ssr_dummies[:, None]
+    std_errors = np.sqrt(ssr / df_resid / ssr_dummies[:, None])
+    p_values = 2 * stats.t.sf(np.abs(coefficients / std_errors), df_resid)
+    return coefficients, std_errors, p_values
+
+def design_matrix(df,controls):
+    # non-numeric controls become treatment-coded dummies, as in the formula interface
+    return pd.get_dummies(df[controls], drop_first=True, dtype=float).to_numpy(dtype=float)
+
+def batched_reg_stats(df_ols,controls=None):
+    controls = list(df_ols.columns[7:]) if controls is None else list(controls)
+    industries = pd.unique(df_ols['Industry'])
+    n_ind, n_y, n_x = len(industries), len(outcomes), len(join_dummies)
+    coefficients, std_errors, p_values = (np.full((n_y, n_ind, n_x), np.nan) for _ in range(3))
+
+    for i, industry in enumerate(industries):
+        with instrument.stage('industry regressions', industry=industry) as record:
+            df = df_ols[df_ols['Industry'] == industry]
+            record['rows'] = len(df)
+            X = design_matrix(df, controls)
+            D = df[join_dummies].to_numpy(dtype=float)
+            Y = df[outcomes].to_numpy(dtype=float)
+            complete = df[controls].notna().all(axis=1).to_numpy() & ~np.isnan(X).any(axis=1)
+                # missing values in any control (get_dummies turns a missing string into a row of zeros)
+            if not (np.isnan(D[complete]).any() or np.isnan(Y[complete]).any()):
+                basis = control_basis(X[complete])
+                b, se, p = fwl_stats(basis, D[complete], Y[complete])
+                coefficients[:, i, :], std_errors[:, i, :], p_values[:, i, :] = b.T, se.T, p.T
+            else:
+                # missing values: each regression uses its own complete cases (as statsmodels does)
+                for k in range(n_x):
+                    for j in range(n_y):
+                        rows = complete & ~np.isnan(D[:, k]) & ~np.isnan(Y[:, j])
+                        b, se, p = fwl_stats(control_basis(X[rows]), D[rows, k:k+1], Y[rows, j:j+1])
+                        coefficients[j, i, k], std_errors[j, i, k], p_values[j, i, k] = b[0, 0], se[0, 0], p[0, 0]
+
+    index = pd.MultiIndex.from_product([[y.split('_')[0] for y in outcomes], industries, join_dummies],
+                                       names=['Trade Type', 'Industry', 'Join_Dummy'])
+        # same order as the loops in all_reg_stats
+    return pd.DataFrame({'Coefficient': coefficients.ravel(), 'Std. Error': std_errors.ravel(),
+                         'p-Value': p_values.ravel()}, index=index).reset_index()
+
+# Run the industries in parallel and cache the results:
+def industry_reg_stats(df_industry,controls):
+    start = time.perf_counter()
+    reg_results = batched_reg_stats(df_industry,controls)
+    reg_results['Fit Time'] = time.perf_counter() - start
+        # seconds for all regressions of the industry
+    return reg_results
+
+def data_hash(df):
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()[:16]
+
+def cached_reg_stats(df_ols,controls=None,max_workers=None,cache_dir=reg_cache_dir):
+    controls = tuple(df_ols.columns[7:] if controls is None else controls)
+    df_ols = df_ols[['Industry'] + outcomes + join_dummies + list(controls)]
+    key = data_hash(df_ols)
+    keys = [(key, y_var, x_var, controls) for y_var in outcomes for x_var in join_dummies]
+
+    if not all(k in reg_cache for k in keys):
+        cache_file = os.path.join(cache_dir, hashlib.sha256(repr((key, controls)).encode()).hexdigest()[:16] + '.feather')
+        if os.path.exists(cache_file):
+            reg_results = pd.read_feather(cache_file)
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                reg_results = pd.concat(pool.map(industry_reg_stats,
+                                                 [df_ols[df_ols['Industry'] == industry] for industry in pd.unique(df_ols['Industry'])],
+                                                 [list(controls)] * df_ols['Industry'].nunique()), ignore_index=True)
+                    # results come back in the order of the industries
+            os.makedirs(cache_dir, exist_ok=True)
+            reg_results.to_feather(cache_file)
+        for y_var in outcomes:
+            for x_var in join_dummies:
+                reg_cache[(key, y_var, x_var, controls)] = reg_results[
+                    (reg_results['Trade Type'] == y_var.split('_')[0]) & (reg_results['Join_Dummy'] == x_var)]
+
+    return pd.concat([reg_cache[k] for k in keys]).sort_index().reset_index(drop=True)
+
+def fit_times(reg_results):
+    # seconds per industry for the results of cached_reg_stats
+    return reg_results.groupby('Industry', sort=False)['Fit Time'].first().sort_values(ascending=False)
+
 # Approximate histogram with Kernel-estimator
 def histogram_estimator(data):
     # Create a figure object
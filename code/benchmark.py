@@ -0,0 +1,211 @@
+"""
+This file times and memory-profiles the main steps of the project on synthetic data (see synthetic_icio.py):
+the stages of prepare_icio, the regressions in analysis, the summary table in exploration and the dashboard callbacks.
+The results can be stored as a baseline, later runs report the stages that got slower or need more memory.
+
+Run it from the /code/ folder:
+    python benchmark.py small medium            # compare with the stored baseline
+    python benchmark.py small medium baseline   # store the results as the new baseline
+"""
+
+import os, sys, json, time, tracemalloc
+import numpy as np
+import pandas as pd
+
+import prepare_icio, analysis, exploration
+import exploration_dash, macro_intro_dash
+from synthetic_icio import write_icio
+from get_eu_euro_members import get_wiki_table
+from codes import industry_table, country_table
+import store
+
+# Data scales (number of countries incl. ROW, number of years):
+scales = {'small': {'countries': 10, 'years': 2},
+          'medium': {'countries': 30, 'years': 2},
+          'full': {'countries': 77, 'years': 2}}
+    # full: size of the original tables (77 countries, 45 industries)
+bench_dir = '../temp/benchmark/'
+baseline_file = '../results/benchmark_baseline.json'
+repeat = 3
+    # each stage is timed several times and the fastest run is kept
+time_tolerance = 0.25
+memory_tolerance = 0.10
+    # allowed increase against the baseline before a stage counts as a regression
+min_slowdown = 0.05
+    # seconds, shorter differences are timing noise
+
+def measure(func, *args):
+    # fastest wall time over several runs, peak memory (traced python and numpy allocations) in a separate run
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+        # tracing slows down the code, so it is not used for the timing
+    return min(seconds), peak / 2**20
+
+# Inputs of the later steps, derived from the collapsed tables:
+def ols_frame(df_short, seed=0):
+    # panel of (country, industry, year) with the columns expected by all_reg_stats (controls from the 8th column on)
+    rng = np.random.default_rng(seed)
+    df = df_short.groupby(['Industry Code', 'Country Code', 'Year'], observed=True, as_index=False)['Sales'].sum()
+    df = pd.concat([df.assign(Year=df['Year'] + 2 * shift) for shift in range(10)], ignore_index=True)
+        # a few more years so that the join dummies vary within industries
+    join_year = dict(zip(df['Country Code'].unique(), rng.integers(df['Year'].min(), df['Year'].max() + 1, df['Country Code'].nunique())))
+    years_after = df['Year'] - df['Country Code'].map(join_year).astype(int)
+    return pd.DataFrame({'Industry': df['Industry Code'].astype(str),
+                         'Exports_Ratio': rng.normal(size=len(df)),
+                         'Imports_Ratio': rng.normal(size=len(df)),
+                         'Five_Years_After': years_after.between(0, 4).astype(int),
+                         'Ten_Years_After': years_after.between(5, 9).astype(int),
+                         'EU_Member': (years_after >= 0).astype(int),
+                         'Three_Years_Around': years_after.between(-1, 1).astype(int),
+                         'Country': df['Country Code'].astype(str),
+                         'Year': df['Year']})
+
+def dashboard_files(df_short, path, seed=0):
+    # csv files in the format of ../temp/ for the dashboards
+    rng = np.random.default_rng(seed)
+    countries, industries = country_table(), industry_table()
+    df_map = df_short.groupby(['Country Code', 'Industry Code', 'Trade Country Code', 'Year'], observed=True, as_index=False)['Sales'].sum()
+    df_map = df_map[df_map['Country Code'] != df_map['Trade Country Code']]
+    df_map = pd.concat([df_map.assign(Year=year) for year in range(1995, 2021)], ignore_index=True)
+        # the map covers all years of the slider
+    df_map['Sales Shares'] = rng.random(len(df_map))
+    df_map['Purchases Shares'] = rng.random(len(df_map))
+    df_map = df_map.merge(industries, on='Industry Code').merge(countries, on='Country Code')
+    df_map.to_csv(os.path.join(path, 'df_map.csv'), index=False)
+
+    df_analysis = df_map.groupby(['Industry', 'Country', 'Year'], as_index=False)[['Sales Shares', 'Purchases Shares']].mean()
+    df_analysis.rename(columns={'Sales Shares': 'Exports in/out EU', 'Purchases Shares': 'Imports in/out EU'}).to_csv(
+        os.path.join(path, 'df_analysis.csv'), index=False)
+
+    dates = pd.date_range('1999-01-01', '2023-12-01', freq='MS')
+    macro_df = pd.DataFrame([(country, group, date) for group, group_countries in
+                             [('Eurozone', countries['Country'][:10]), ('Non-Euro', countries['Country'][10:20])]
+                             for country in group_countries for date in dates], columns=['Country', 'Country Group', 'Date'])
+    for indicator in ['Inflation', 'Unemployment', 'Long-Term Interest Rate']:
+        macro_df[indicator] = rng.normal(3, 1, len(macro_df))
+    macro_df.to_csv(os.path.join(path, 'macro-data.csv'), index=False)
+
+# Benchmark all stages for one scale:
+def run_scale(scale, seed=0):
+    settings = scales[scale]
+    countries = prepare_icio.icio_countries[:settings['countries'] - 1] + ['ROW']
+    years = list(range(2000, 2000 + settings['years']))
+    path = os.path.join(bench_dir, f"{scale}_{settings['countries']}x{settings['years']}_{seed}/")
+    write_icio(years, path, countries, seed=seed)
+    members = list(get_wiki_table('EU')['Country Code'])
+    flags = {'Intra-EU Trade': 'EU'}
+    file = os.path.join(path, f'{years[0]}_SML.csv')
+    results = []
+
+    def stage(name, func, *args):
+        seconds, peak_mb = measure(func, *args)
+        results.append({'Scale': scale, 'Stage': name, 'Seconds': seconds, 'Peak MB': peak_mb})
+        print(f"{scale:>8} {name:<34} {seconds:9.3f} s {peak_mb:9.1f} MB")
+
+    # prepare_icio (one year, then the whole dataset):
+    data = prepare_icio.icio_to_dataframe(file)
+    df_long = prepare_icio.wide_to_long(data, 'Sales', years[0])
+    df_long_compact = prepare_icio.wide_to_long(data, 'Sales', years[0], compact=True)
+    df_short = prepare_icio.collapse_row(df_long.copy(), members)
+    for backend in ['pandas', 'arrow']:
+        stage(f'icio_to_dataframe {backend}', prepare_icio.icio_to_dataframe, file, backend)
+            # the peak of the arrow backend is understated: tracemalloc does not see the memory allocated by pyarrow
+    stage('wide_to_long', prepare_icio.wide_to_long, data, 'Sales', years[0])
+    stage('wide_to_long compact', prepare_icio.wide_to_long, data, 'Sales', years[0], True)
+    stage('collapse_row', lambda: prepare_icio.collapse_row(df_long.copy(), members))
+    stage('collapse_row compact', lambda: prepare_icio.collapse_row(df_long_compact.copy(), members))
+    stage('collapse_row_dense', prepare_icio.collapse_row_dense, data, members, 'Sales', years[0])
+    stage('classify_trade', lambda: prepare_icio.classify_trade(df_short.copy(), 'EU', 'Intra-EU Trade'))
+    for engine in ['pandas', 'dense']:
+        stage(f'build_dataset {engine}', prepare_icio.build_dataset, years, members, 'Sales', flags,
+              os.path.join(path, 'full_dataset.csv'), engine, path, False)
+
+    # analysis and exploration:
+    df_ols = ols_frame(df_short, seed)
+    for engine in ['statsmodels', 'batched']:
+        stage(f'all_reg_stats {engine}', analysis.all_reg_stats, df_ols, 1, engine)
+    stage('summary_table', exploration.summary_table, df_short, 'Sales', years[0])
+    stage('summary_statistics', exploration.summary_statistics, df_short, ['Sales'])
+    statistics = exploration.summary_statistics(df_short, ['Sales'])
+    stage('summary_table lookup', exploration.summary_table, df_short, 'Sales', years[0], statistics)
+
+    # dashboards (figures are built from scratch, the figure caches are cleared before each call):
+    dashboard_files(df_short, path, seed)
+    exploration_dash.map_file = os.path.join(path, 'df_map.csv')
+    exploration_dash.timeline_file = os.path.join(path, 'df_analysis.csv')
+    macro_intro_dash.macro_file = os.path.join(path, 'macro-data.csv')
+    loaders = [exploration_dash.load_map_data, exploration_dash.load_timeline_data]
+    figures = [exploration_dash.map_figure, exploration_dash.animation_figure, exploration_dash.timeline_figure,
+               macro_intro_dash.macro_figure, exploration_dash.load_map_selection, exploration_dash.load_timeline_selection,
+               macro_intro_dash.load_macro_data]
+        # the selections are read from the Parquet datasets by the callbacks, so their caches are cleared as well
+    def load_dashboards():
+        for loader in loaders:
+            loader.cache_clear()
+            loader()
+    def uncached(callback, *args):
+        for figure in figures:
+            figure.cache_clear()
+        return callback(*args)
+    stage('dashboard store', lambda: [store.csv_to_dataset(os.path.join(path, file))
+                                      for file in ['df_map.csv', 'df_analysis.csv', 'macro-data.csv']])
+    stage('dashboard data', load_dashboards)
+    industry, country_code = pd.read_csv(os.path.join(path, 'df_map.csv'), usecols=['Industry', 'Country Code'], nrows=1).iloc[0][['Industry', 'Country Code']]
+    sectors, countries = exploration_dash.load_timeline_data()[:2]
+    click = {'points': [{'location': country_code}]}
+    stage('update_map', uncached, exploration_dash.update_map, industry, 'Sales Shares', 1995, click, 0)
+    stage('update_map animation', uncached, exploration_dash.update_map, industry, 'Sales Shares', 1995, click, 1)
+    stage('update_graph timeline', uncached, exploration_dash.update_graph, sectors[0], countries[0])
+    stage('update_graph macro', uncached, macro_intro_dash.update_graph, 'Inflation')
+    return results
+
+# Compare with the baseline:
+def compare(results, baseline):
+    df = pd.DataFrame(results)
+    if not baseline:
+        return df.assign(Regression=False)
+    df = df.merge(pd.DataFrame(baseline), on=['Scale', 'Stage'], how='left', suffixes=('', ' Baseline'))
+    df['Time Ratio'] = df['Seconds'] / df['Seconds Baseline']
+    df['Memory Ratio'] = df['Peak MB'] / df['Peak MB Baseline']
+    df['Regression'] = (((df['Time Ratio'] > 1 + time_tolerance) & (df['Seconds'] - df['Seconds Baseline'] > min_slowdown)) |
+                        (df['Memory Ratio'] > 1 + memory_tolerance))
+        # stages without a baseline (new stages or scales) are not counted as regressions
+    return df
+
+def read_baseline(file=baseline_file):
+    if os.path.exists(file):
+        with open(file) as f:
+            return json.load(f)
+    return []
+
+def write_baseline(results, file=baseline_file):
+    # results of other scales in the stored baseline are kept
+    run = {(r['Scale'], r['Stage']) for r in results}
+    baseline = [r for r in read_baseline(file) if (r['Scale'], r['Stage']) not in run] + results
+    os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+    with open(file + '.tmp', 'w') as f:
+        json.dump(baseline, f, indent=2)
+    os.replace(file + '.tmp', file)
+
+def run(selected_scales=('small',), save_baseline=False):
+    results = [result for scale in selected_scales for result in run_scale(scale)]
+    report = compare(results, read_baseline())
+    if save_baseline:
+        write_baseline(results)
+    return report
+
+if __name__ == '__main__':
+    selected = [arg for arg in sys.argv[1:] if arg in scales] or ['small']
+    report = run(selected, save_baseline='baseline' in sys.argv[1:])
+    pd.set_option('display.width', 200)
+    print(report.round(3).to_string(index=False))
+    if report['Regression'].any():
+        print(f"{report['Regression'].sum()} stages got slower or need more memory than in the baseline")
+        sys.exit(1)
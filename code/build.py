@@ -0,0 +1,136 @@
+"""
+This file rebuilds the derived datasets incrementally: every input and intermediate step is fingerprinted
+per year and stage, and only the years whose fingerprint changed are recomputed.
+    collapse:  IO-table of the year (content hash), drop rules, members, variable and engine
+    classify:  collapsed year and the trade flags (for a zone: its members in that year)
+    map:       classified year and the code names (codes.xlsx), as in exploration.dataframe_map
+The partitions are kept as feather files in ../temp/build/ and the fingerprints in its manifest.json,
+the output files (csv and Parquet dataset, see store.py) are put together from the partitions whenever one of them changed.
+A new year is thus processed on its own, and a change in the membership tables only re-runs the
+classification (and the map) of the years in which the members of the zone actually changed.
+"""
+
+import os, json, hashlib
+import pandas as pd
+
+from prepare_icio import (collapse_year, classify_trade, file_hash, drop_columns, drop_rows, icio_dir,
+                          dataset_file, icio_countries)
+from get_eu_euro_members import is_member, membership_intervals
+from codes import codes_file
+from store import write_dataset
+import instrument
+
+build_dir = '../temp/build/'
+build_version = 1
+    # part of every fingerprint, increase it when the code of a stage changes so that all partitions are rebuilt
+
+def fingerprint(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+def read_manifest(path=build_dir):
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    return {}
+
+def write_manifest(manifest, path=build_dir):
+    with open(os.path.join(path, 'manifest.json.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(os.path.join(path, 'manifest.json.tmp'), os.path.join(path, 'manifest.json'))
+
+def content_hash(file, manifest):
+    # sha256 of a file, only recomputed if its size or modification time changed since the last build
+    stat = os.stat(file)
+    known = manifest.setdefault('files', {}).get(file)
+    if known is None or known['size'] != stat.st_size or known['mtime'] != stat.st_mtime_ns:
+        known = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': file_hash(file)}
+        manifest['files'][file] = known
+    return known['sha256']
+
+def flag_targets(flags, year, intervals):
+    # countries behind each flag in the given year (members of a zone change over time)
+    targets = {}
+    for flag, target in flags.items():
+        if isinstance(target, str):
+            members = is_member(target, icio_countries, [year] * len(icio_countries), intervals)
+            targets[flag] = (target, sorted(c for c, member in zip(icio_countries, members) if member))
+        else:
+            targets[flag] = sorted(target)
+    return sorted(targets.items())
+
+def partition(stage, year, path=build_dir):
+    return os.path.join(path, stage, f'{year}.feather')
+
+def run_stage(manifest, stage, year, key, compute, path=build_dir):
+    # compute() is only called if the fingerprint of the partition changed (or the file is missing)
+    file = partition(stage, year, path)
+    if manifest.get(stage, {}).get(str(year)) == key and os.path.exists(file):
+        return False
+    df = compute()
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    df.reset_index(drop=True).to_feather(file + '.tmp')
+    os.replace(file + '.tmp', file)
+    manifest.setdefault(stage, {})[str(year)] = key
+    write_manifest(manifest, path)
+        # written after every partition, so an interrupted build keeps the finished ones
+    return True
+
+def combine(manifest, stage, years, out_file, path=build_dir):
+    # write the partitions of the years to one csv file and its Parquet dataset (only if one of them changed)
+    key = fingerprint([manifest[stage][str(year)] for year in years])
+    if manifest.get('outputs', {}).get(out_file) == key and os.path.exists(out_file):
+        return False
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    for counter, year in enumerate(years):
+        pd.read_feather(partition(stage, year, path)).to_csv(out_file + '.part', mode='a' if counter else 'w',
+                                                             header=(counter == 0), index=False)
+    os.replace(out_file + '.part', out_file)
+    write_dataset((pd.read_feather(partition(stage, year, path)) for year in years), out_file)
+        # partitioned by year and industry for the readers in store.py (recorded with the new csv file, so it is not converted again)
+    manifest.setdefault('outputs', {})[out_file] = key
+    write_manifest(manifest, path)
+    return True
+
+def build(years,members,var,flags,out_file=dataset_file,map_file=None,engine='pandas',path=icio_dir,
+          compact=False,float32=False,build_path=build_dir):
+    # same arguments as prepare_icio.build_dataset, map_file: also write exploration.dataframe_map of the dataset
+    years = list(years)
+    os.makedirs(build_path, exist_ok=True)
+    manifest = read_manifest(build_path)
+    intervals = membership_intervals()
+    if map_file is not None:
+        from exploration import dataframe_map
+        codes_hash = content_hash(codes_file, manifest)
+    recomputed = {'collapse': [], 'classify': [], 'map': []}
+
+    for counter, year in enumerate(years, start=1):
+        collapse_key = fingerprint(build_version, content_hash(f'{path}{year}_SML.csv', manifest), drop_columns, drop_rows,
+                                   sorted(members), var, engine, compact, float32)
+        classify_key = fingerprint(build_version, collapse_key, flag_targets(flags, year, intervals))
+
+        with instrument.stage('build year', year):
+            if run_stage(manifest, 'collapse', year, collapse_key,
+                         lambda: collapse_year(year,members,var,engine,path,True,compact,float32), build_path):
+                recomputed['collapse'].append(year)
+
+            def classify():
+                df_short = pd.read_feather(partition('collapse', year, build_path))
+                for flag, targets in flags.items():
+                    df_short = classify_trade(df_short,targets,flag)
+                return df_short
+            if run_stage(manifest, 'classify', year, classify_key, classify, build_path):
+                recomputed['classify'].append(year)
+
+            if map_file is not None:
+                map_key = fingerprint(build_version, classify_key, codes_hash)
+                if run_stage(manifest, 'map', year, map_key,
+                             lambda: dataframe_map(pd.read_feather(partition('classify', year, build_path))), build_path):
+                    recomputed['map'].append(year)
+
+        changed = [stage for stage, changed_years in recomputed.items() if year in changed_years]
+        print(f"Data for {year} {'recomputed (' + ', '.join(changed) + ')' if changed else 'up to date'} (year {counter}/{len(years)})")
+
+    combine(manifest, 'classify', years, out_file, build_path)
+    if map_file is not None:
+        combine(manifest, 'map', years, map_file, build_path)
+    return recomputed
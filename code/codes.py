@@ -0,0 +1,85 @@
+"""
+This file translates country and industry codes for whole columns at once:
+the code tables (industries and countries from codes.xlsx, ISO codes and names from pycountry) are read once,
+stored as feather files in ../temp/codes/ and kept in memory, so that neither the Excel file nor pycountry
+is queried again. Codes that are not in a table become missing values.
+"""
+
+import os, hashlib
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+codes_file = '../assets/codes.xlsx'
+codes_cache_dir = '../temp/codes/'
+
+def cached_table(name, key, load, cache_dir=codes_cache_dir):
+    cache_file = os.path.join(cache_dir, f'{name}_{key}.feather')
+    if os.path.exists(cache_file):
+        return pd.read_feather(cache_file)
+    table = load()
+    os.makedirs(cache_dir, exist_ok=True)
+    table.to_feather(cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+    return table
+
+def codes_file_key(file=codes_file):
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+@lru_cache(maxsize=None)
+def industry_table():
+    # columns 'Industry Code' and 'Industry'
+    return cached_table('industries', codes_file_key(), lambda: pd.read_excel(codes_file, sheet_name='Industries'))
+
+@lru_cache(maxsize=None)
+def country_table():
+    # columns 'Country Code' and 'Country'
+    return cached_table('countries', codes_file_key(), lambda: pd.read_excel(codes_file, sheet_name='Countries'))
+
+def load_iso_table():
+    import pycountry
+    return pd.DataFrame([(c.alpha_2, c.alpha_3, c.name) for c in pycountry.countries], columns=['ISO2', 'ISO3', 'Name'])
+
+@lru_cache(maxsize=None)
+def iso_table():
+    # columns 'ISO2', 'ISO3' and 'Name' (pycountry names, e.g. 'Korea, Republic of')
+    from importlib.metadata import version
+    return cached_table('iso', version('pycountry'), load_iso_table)
+
+@lru_cache(maxsize=None)
+def lookup(table, key, value):
+    # index of the codes and array of the values, with a missing value at the end for unknown codes (position -1)
+    df = table()
+    return pd.Index(df[key]), np.append(df[value].to_numpy(dtype=object), None)
+
+def translate(values, table, key, value):
+    keys, targets = lookup(table, key, value)
+    if np.ndim(values) == 0:
+        return targets[keys.get_indexer([values])[0]]
+            # single code
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # only the categories are looked up, the result is categorical again
+        name_codes, names = pd.factorize(targets[keys.get_indexer(series.cat.categories)], sort=True)
+        result = pd.Series(pd.Categorical.from_codes(np.append(name_codes, -1)[series.cat.codes.to_numpy()], categories=names),
+                           index=series.index)
+    else:
+        result = pd.Series(targets[keys.get_indexer(series)], index=series.index)
+    return result if isinstance(values, pd.Series) else result.to_numpy()
+
+# Translations used in the other modules:
+def industry_names(values):
+    return translate(values, industry_table, 'Industry Code', 'Industry')
+
+def country_names(values):
+    return translate(values, country_table, 'Country Code', 'Country')
+
+def iso2_to_iso3(values):
+    return translate(values, iso_table, 'ISO2', 'ISO3')
+
+def iso3_to_name(values):
+    return translate(values, iso_table, 'ISO3', 'Name')
+
+def iso2_to_name(values):
+    return translate(values, iso_table, 'ISO2', 'Name')
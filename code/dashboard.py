@@ -0,0 +1,52 @@
+"""
+This file serves all dashboards (map, timeline and macro indicators) from one process:
+a single flask server routes /map/, /timeline/ and /macro/ to the Dash apps, which share
+the data loaded by exploration_dash and macro_intro_dash.
+
+Run it from the /code/ folder, either directly (python dashboard.py) or with several workers:
+    gunicorn --preload --workers 4 dashboard:server
+With --preload the Parquet datasets are built (if needed) and the dropdown options loaded once before the workers
+are forked, so they share this memory (copy-on-write), each worker then reads and caches the selections it serves.
+"""
+
+import gc
+from flask import Flask
+
+from exploration_dash import (map_app, timeline_app, load_map_data, load_timeline_data,
+                              precompute_map_figures, precompute_timeline_figures)
+from macro_intro_dash import macro_app, load_macro_data, macro_indicators
+
+preload_data = True
+    # load the dropdown options and the macro indicators when the module is imported (otherwise on the first request of each dashboard),
+    # the trade data is read per selection from the Parquet datasets (see store.py)
+precompute_figures = False
+    # also build the figures of the default selections during the preload (or: preload(figures=True))
+
+server = Flask(__name__)
+app_map = map_app(server=server, url_base_pathname='/map/')
+app_timeline = timeline_app(server=server, url_base_pathname='/timeline/')
+app_macro = macro_app(server=server, url_base_pathname='/macro/')
+
+@server.route('/')
+def index():
+    return ('<h1>Dashboards</h1><ul>'
+            '<li><a href="/map/">European Export and Import Patterns over Time</a></li>'
+            '<li><a href="/timeline/">Change in Relative Trade with other EU Members</a></li>'
+            '<li><a href="/macro/">Macro indicators for different country groups in Europe</a></li></ul>')
+
+def preload(figures=None):
+    load_map_data()
+    load_timeline_data()
+    for indicator in macro_indicators:
+        load_macro_data(indicator)
+    if precompute_figures if figures is None else figures:
+        precompute_map_figures()
+        precompute_timeline_figures()
+    gc.freeze()
+        # move the loaded objects out of the garbage collector, which would otherwise touch (and copy) their pages in every worker
+
+if preload_data:
+    preload()
+
+if __name__ == '__main__':
+    server.run(port=8050)
@@ -8,6 +8,8 @@ import plotly.io as pio
 pio.templates.default = "seaborn"
 import statsmodels.formula.api as sm
 from scipy.stats import gaussian_kde
+import instrument
+from codes import industry_table, industry_names, country_names
 #from sklearn.linear_model import LinearRegression
 
 # Create dataframe for first map-chart
@@ -17,10 +19,14 @@ def dataframe_map(df):
                    # ['Country Code','Industry Code','Trade Country Code','Year']).sum().reset_index()
 
     # Add full names for countries and industries (previously only codes):
-    df_map = pd.merge(df_map,pd.read_excel('../assets/codes.xlsx',sheet_name='Industries'),on='Industry Code')
-    df_map = pd.merge(df_map,pd.read_excel('../assets/codes.xlsx',sheet_name='Countries'),on='Country Code')
-    df_map = pd.merge(df_map,pd.read_excel('../assets/codes.xlsx',sheet_name='Countries').rename(
-                    columns={'Country Code':'Trade Country Code','Country':'Trade Country'}),on='Trade Country Code')
+    with instrument.stage('translate codes') as record:
+        df_map['Industry'] = industry_names(df_map['Industry Code'])
+        df_map['Country'] = country_names(df_map['Country Code'])
+        df_map['Trade Country'] = country_names(df_map['Trade Country Code'])
+            # categorical codes (compact schema) give categorical names
+        df_map = df_map.dropna(subset=['Industry','Country','Trade Country']).reset_index(drop=True)
+            # codes that are not in codes.xlsx are dropped
+        record['rows'] = len(df_map)
 
     # Delete sales in own country (not relevant for figure):
     df_map = df_map[df_map['Country'] != df_map['Trade Country']]
@@ -35,16 +41,30 @@ def q75(x):
 def coef_var(x):
     return x.std() / x.mean()
 
-def summary_table(df,var,year):
-    df_statistics = (df[df['Year']==year][['Industry Code','Country Code','Year',var]].
-    groupby(['Year','Industry Code','Country Code']).sum().reset_index().groupby(['Year','Industry Code']).agg(
-            Mean_Sales=(var, 'mean'),
-            Q25_Sales=(var, q25),
-            Median_Sales=(var, 'median'),
-            Q75_Sales=(var, q75),
-            Variance_Coefficient_Sales=(var, coef_var)
-    ))
-    df_statistics = pd.merge(pd.read_excel('../assets/codes.xlsx',sheet_name='Industries'),df_statistics,on='Industry Code').drop('Industry Code',axis=1)
+# Statistics of the country totals for all years, industries and variables in one pass (tidy table).
+# Compute it once and pass it to summary_table, so that every further year is only a lookup:
+#     statistics = summary_statistics(df, ['Sales'])
+#     tables = {year: summary_table(df, 'Sales', year, statistics) for year in range(1995, 2021)}
+def summary_statistics(df,variables):
+    with instrument.stage('summary statistics') as record:
+        country_totals = df.groupby(['Year','Industry Code','Country Code'], observed=True)[list(variables)].sum()
+        grouped = country_totals.groupby(level=['Year','Industry Code'], observed=True)
+            # only built-in aggregations, which pandas runs in compiled code
+        statistics = pd.concat({'Mean': grouped.mean(), 'Q25': grouped.quantile(0.25), 'Median': grouped.median(),
+                                'Q75': grouped.quantile(0.75), 'Variance_Coefficient': grouped.std() / grouped.mean()},
+                               names=['Statistic'])
+        statistics = (statistics.rename_axis(columns='Variable').stack().unstack('Statistic')
+                      [['Mean','Q25','Median','Q75','Variance_Coefficient']].rename_axis(columns=None).reset_index())
+        record['rows'] = len(statistics)
+    return statistics
+
+def summary_table(df,var,year,statistics=None):
+    # statistics: table of summary_statistics (with var), without it only the rows of the year are computed
+    if statistics is None:
+        statistics = summary_statistics(df[df['Year'] == year],[var])
+    df_statistics = (statistics[(statistics['Year'] == year) & (statistics['Variable'] == var)]
+                     .set_index('Industry Code').drop(['Year','Variable'],axis=1).add_suffix('_Sales'))
+    df_statistics = pd.merge(industry_table(),df_statistics,on='Industry Code').drop('Industry Code',axis=1)
     for c in df_statistics.columns[1:5]:
         df_statistics[c] = df_statistics[c] / 1000
         df_statistics[c] = df_statistics[c].round(0).astype(int)
@@ -1,109 +1,150 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
     # this avoids a warning when using the replace command
-import pandas as pd
+from functools import lru_cache
 import plotly.express as px
 import plotly.io as pio
 pio.templates.default = "seaborn"
 
-from dash import Dash, dcc, html, Input, Output, State
+from dash import Dash, dcc, html, Input, Output
+
+from store import read_dataset, partition_values
+
+figure_cache_size = 512
+    # number of figures kept in memory per chart (least recently used ones are dropped first)
+map_file = '../temp/df_map.csv'
+timeline_file = '../temp/df_analysis.csv'
+    # read through the partitioned Parquet datasets next to the csv files (see store.py)
 
 #---------------------------------------------------------------------------------------------------------------
 # Create first Dash application
 
-df_map = pd.read_csv('../temp/df_map.csv')
-app_map = Dash(__name__)
-
-# Layout of the dashboard
-app_map.layout = html.Div([
-    html.H1("European Export and Import Patterns over Time"),
-
-    html.Div([
-        # Dropdown for Industry selection
-        dcc.Dropdown(
-            id='industry-dropdown',
-            options=[{'label': industry, 'value': industry} for industry in df_map['Industry'].unique()],
-            value='Machinery and equipment',  # default option
-            clearable=False,
-            style={'width': '100%'}
-        ),
+# Only the dropdown options are read for the layout, the callbacks read the rows of their selection
+# (partitions of the industry, rows of the country, only the columns of the figure):
+@lru_cache(maxsize=None)
+def load_map_data():
+    # industries from the partition folders, in alphabetical order (not in the order of the rows of df_map.csv)
+    return partition_values(map_file, 'Industry')
+
+@lru_cache(maxsize=figure_cache_size)
+def load_map_selection(selected_country_code, selected_industry):
+    df_map = read_dataset(map_file, filters=[('Industry', '==', selected_industry), ('Country Code', '==', selected_country_code)],
+                          columns=['Year', 'Trade Country Code', 'Sales Shares', 'Purchases Shares']).sort_values('Year')
+    map_color_range = df_map[['Sales Shares', 'Purchases Shares']].max().to_dict()
+        # maximum of both shares over all years, keeps the color scale fixed over the years
+    return df_map, map_color_range
+
+# Layout of the dashboard (a function, so that the data is only loaded when the page is first requested)
+def map_layout(industries=None):
+    if industries is None:
+        industries = load_map_data()
+    return html.Div([
+        html.H1("European Export and Import Patterns over Time"),
 
-        # Dropdown for selecting Exports or Imports
-        dcc.Dropdown(
-            id='trade-type-dropdown',
-            options=[
-                {'label': 'Sales Shares', 'value': 'Sales Shares'},
-                {'label': 'Purchases Shares', 'value': 'Purchases Shares'}
-            ],
-            value='Sales Shares',  # default option
-            clearable=False,
-            style={'width':'100%'}
-        ),
-
-        # Display selected Country Code, styled like a dropdown
-        html.Div(id='selected-country', style={
-            'fontSize': 15,
-            'width': '80%',
-            'backgroundColor': 'white',
-            'border': '1px solid black',
-            'padding': '6px',
-            'borderRadius': '5px',
-            'align-items': 'center'
-        }),
-
-        # Button to start the animation
-        html.Button('Animate', id='start-animation', n_clicks=0, style={'width':'15%','padding': '6px'}),
-
-    ], style={'display': 'flex', 'padding-top':'20px', 'align-items': 'center'}),
-
-    # Slider for selecting Year
-    dcc.Slider(
-        id='year-slider',
-        min=1995,
-        max=2020,
-        step=1,
-        value=1995,  # Default to the minimum year
-        marks=dict(zip(range(1995, 2021), [str(i) for i in range(1995, 2021)]))
-    ),
-
-    # Hidden interval component to control the year animation
-    dcc.Interval(
-        id='year-interval',
-        interval=500,  # Interval in milliseconds (1 second)
-        n_intervals=0,   # Number of intervals passed
-        disabled=True    # Initially disabled
-    ),
-
-    # Choropleth Map
-    dcc.Graph(id='graph')
-
-], style={'backgroundColor': '#f0f0f0', 'padding': '20px'})
-
-
-# Callback to handle map updates based on the selected inputs and animation
-@app_map.callback(
-    [Output('graph', 'figure'),
-     Output('selected-country', 'children')],
-    [Input('industry-dropdown', 'value'),
-     Input('trade-type-dropdown', 'value'),
-     Input('year-slider', 'value'),
-     Input('graph', 'clickData')]
-)
-
-def update_map(selected_industry, selected_trade_type, selected_year, click_data):
+        html.Div([
+            # Dropdown for Industry selection
+            dcc.Dropdown(
+                id='industry-dropdown',
+                options=[{'label': industry, 'value': industry} for industry in industries],
+                value='Machinery and equipment',  # default option
+                clearable=False,
+                style={'width': '100%'}
+            ),
+
+            # Dropdown for selecting Exports or Imports
+            dcc.Dropdown(
+                id='trade-type-dropdown',
+                options=[
+                    {'label': 'Sales Shares', 'value': 'Sales Shares'},
+                    {'label': 'Purchases Shares', 'value': 'Purchases Shares'}
+                ],
+                value='Sales Shares',  # default option
+                clearable=False,
+                style={'width':'100%'}
+            ),
+
+            # Display selected Country Code, styled like a dropdown
+            html.Div(id='selected-country', style={
+                'fontSize': 15,
+                'width': '80%',
+                'backgroundColor': 'white',
+                'border': '1px solid black',
+                'padding': '6px',
+                'borderRadius': '5px',
+                'align-items': 'center'
+            }),
+
+            # Button to start the animation
+            html.Button('Animate', id='start-animation', n_clicks=0, style={'width':'15%','padding': '6px'}),
+
+        ], style={'display': 'flex', 'padding-top':'20px', 'align-items': 'center'}),
+
+        # Slider for selecting Year (hidden in the animation, which has its own play button and slider)
+        html.Div(dcc.Slider(
+            id='year-slider',
+            min=1995,
+            max=2020,
+            step=1,
+            value=1995,  # Default to the minimum year
+            marks=dict(zip(range(1995, 2021), [str(i) for i in range(1995, 2021)]))
+        ), id='year-slider-container'),
+
+        # Choropleth Map
+        dcc.Graph(id='graph')
+
+    ], style={'backgroundColor': '#f0f0f0', 'padding': '20px'})
+
+
+def map_app(server=True, url_base_pathname='/'):
+    # server: flask server to attach the app to (True creates its own), url_base_pathname: route of the app on it
+    app_map = Dash(__name__, server=server, url_base_pathname=url_base_pathname)
+    app_map.validation_layout = map_layout(industries=[])
+        # Dash checks the callbacks against this empty layout, otherwise it would call map_layout (and load the data) right away
+    app_map.layout = map_layout
+
+    # Callback to handle map updates based on the selected inputs and animation
+    app_map.callback(
+        [Output('graph', 'figure'),
+         Output('selected-country', 'children'),
+         Output('start-animation', 'children'),
+         Output('year-slider-container', 'style')],
+        [Input('industry-dropdown', 'value'),
+         Input('trade-type-dropdown', 'value'),
+         Input('year-slider', 'value'),
+         Input('graph', 'clickData'),
+         Input('start-animation', 'n_clicks')]
+    )(update_map)
+    return app_map
+
+def update_map(selected_industry, selected_trade_type, selected_year, click_data, n_clicks):
     # Default option
     selected_country_code = 'POL'
     # If a country is clicked, update the selected country code
     if click_data:
         selected_country_code = click_data['points'][0]['location']
 
-    # Filter the DataFrame based on the selected Country Code, Industry, and Year
-    filtered_df = df_map[
-        (df_map['Country Code'] == selected_country_code) &
-        (df_map['Industry'] == selected_industry) &
-        (df_map['Year'] == selected_year)
-    ]
+    # Every second click on the button shows the animation (played with the buttons and slider of the figure),
+    # the others return to the selected year
+    if n_clicks % 2 == 1:
+        return *animation_figure(selected_country_code, selected_industry, selected_trade_type), 'Single year', {'display': 'none'}
+    return *map_figure(selected_country_code, selected_industry, selected_trade_type, selected_year), 'Animate', {}
+
+
+# Figures are cached by their inputs (map_figure.cache_info() shows hits and misses):
+@lru_cache(maxsize=figure_cache_size)
+def map_figure(selected_country_code, selected_industry, selected_trade_type, selected_year):
+    # Select the rows for the selected Country Code, Industry, and Year
+    df_map = load_map_selection(selected_country_code, selected_industry)[0]
+    filtered_df = df_map[df_map['Year'] == selected_year]
+    return choropleth(filtered_df, selected_country_code, selected_industry, selected_trade_type)
+
+@lru_cache(maxsize=figure_cache_size)
+def animation_figure(selected_country_code, selected_industry, selected_trade_type):
+    # All years in one figure with animation frames, so the animation runs in the browser without further requests
+    filtered_df = load_map_selection(selected_country_code, selected_industry)[0]
+    return choropleth(filtered_df, selected_country_code, selected_industry, selected_trade_type, animation_frame='Year')
 
+def choropleth(filtered_df, selected_country_code, selected_industry, selected_trade_type, animation_frame=None):
     # Check if the filtered DataFrame is empty
     if filtered_df.empty:
         fig = px.choropleth()  # Create an empty figure
@@ -119,9 +160,13 @@ def update_map(selected_industry, selected_trade_type, selected_year, click_data
             color=selected_trade_type,  # Color countries by the selected trade type (Exports or Imports)
             hover_name='Trade Country Code',  # Hover info shows the Trade Country Code
             color_continuous_scale=px.colors.sequential.Plasma,
-            range_color=[0,max(df_map[(df_map['Country Code'] == selected_country_code)&(df_map['Industry'] == selected_industry)][selected_trade_type])]
+            range_color=[0,load_map_selection(selected_country_code, selected_industry)[1][selected_trade_type]],
+            animation_frame=animation_frame
         )
         selected_country_text = f"Selected Country: {selected_country_code}"
+        if animation_frame and fig.layout.updatemenus:
+            fig.layout.updatemenus[0].buttons[0].args[1]['frame']['duration'] = 500
+                # show each year for 500 milliseconds (a selection with a single year has no play button)
 
     # Update layout for better map visualization, limit to Europe
     fig.update_layout(
@@ -135,92 +180,94 @@ def update_map(selected_industry, selected_trade_type, selected_year, click_data
 
     return fig, selected_country_text
 
+def precompute_map_figures():
+    # figures of the default view for all years (loads the data, called by dashboard.preload)
+    for year in range(1995, 2021):
+        map_figure('POL', 'Machinery and equipment', 'Sales Shares', year)
+    animation_figure('POL', 'Machinery and equipment', 'Sales Shares')
 
-# Callback to handle year slider animation
-@app_map.callback(
-    Output('year-slider', 'value'),
-    [Input('year-interval', 'n_intervals')],
-    [State('year-slider', 'value')]
-)
-
-def update_year(n_intervals, current_year):
-    # Update the year based on the interval (loop from 1995 to 2020)
-    if current_year >= 2020:
-        return 1995  # Reset to the minimum year
-    else:
-        return current_year + 1
-
-
-# Callback to enable the interval (animation) when the button is clicked
-@app_map.callback(
-    Output('year-interval', 'disabled'),
-    [Input('start-animation', 'n_clicks')],
-    [State('year-interval', 'disabled')]
-)
-
-def toggle_animation(n_clicks, interval_disabled):
-    # Start or stop the animation based on button clicks
-    if n_clicks > 0:
-        return not interval_disabled
-    return interval_disabled
+app_map = map_app()
 
 
 #---------------------------------------------------------------------------------------------------------------
 # Create second Dash application
 from get_eu_euro_members import *
-df_analysis = pd.read_csv('../temp/df_analysis.csv')
-eu_join = get_wiki_table('EU')
-eu_join_year = dict(zip(eu_join['Country'], eu_join['Year']))
 
-# Initialize the Dash app inside Jupyter
-app_timeline = Dash(__name__)
+@lru_cache(maxsize=None)
+def load_timeline_data():
+    # dropdown options and EU accession years, the callback reads the rows of its selection
+    df_options = read_dataset(timeline_file, columns=['Industry', 'Country'])
+    eu_join = get_wiki_table('EU')
+    eu_join_year = dict(zip(eu_join['Country'], eu_join['Year']))
+    return df_options['Industry'].unique(), df_options['Country'].unique(), eu_join_year
+
+@lru_cache(maxsize=figure_cache_size)
+def load_timeline_selection(selected_sector, selected_country):
+    return read_dataset(timeline_file, filters=[('Industry', '==', selected_sector), ('Country', '==', selected_country)],
+                        columns=['Year', 'Exports in/out EU', 'Imports in/out EU']).sort_values('Year')
 
 # Layout for the Dash App
-app_timeline.layout = html.Div([
-    html.H1("Change in Relative Trade with other EU Members"),
+def timeline_layout(sectors=None, countries=None):
+    if sectors is None:
+        sectors, countries = load_timeline_data()[:2]
+    return html.Div([
+        html.H1("Change in Relative Trade with other EU Members"),
 
-    # Div for placing selectors side by side
-    html.Div([
-        # Dropdown for Sector Selection
+        # Div for placing selectors side by side
         html.Div([
-            html.Label("Select Sector:"),
-            dcc.Dropdown(
-                id='sector-dropdown',
-                options=[{'label': sector, 'value': sector} for sector in df_analysis['Industry'].unique()],
-                value=df_analysis['Industry'].unique()[0],  # Default value
-                clearable=False
-            )
-        ], style={'width': '40%', 'display': 'inline-block'}),  # Set width and inline-block
-
-        # Dropdown for Country Selection
-        html.Div([
-            html.Label("Select Country:"),
-            dcc.Dropdown(
-                id='country-dropdown',
-                options=[{'label': country, 'value': country} for country in df_analysis['Country'].unique()],
-                value=df_analysis['Country'].unique()[0],  # Default value
-                clearable=False
-            )
-        ], style={'width': '20%', 'display': 'inline-block', 'marginLeft': '2%'})  # Adjust margin for spacing
-    ], style={'marginBottom': '30px'}),
-
-    # Graph with custom width
-    dcc.Graph(
-        id='line-chart',
-        style={'width': '90%', 'margin': '0 auto'}
-    )
-], style={'backgroundColor': '#f0f0f0', 'padding': '20px'})
+            # Dropdown for Sector Selection
+            html.Div([
+                html.Label("Select Sector:"),
+                dcc.Dropdown(
+                    id='sector-dropdown',
+                    options=[{'label': sector, 'value': sector} for sector in sectors],
+                    value=sectors[0] if len(sectors) else None,  # Default value
+                    clearable=False
+                )
+            ], style={'width': '40%', 'display': 'inline-block'}),  # Set width and inline-block
+
+            # Dropdown for Country Selection
+            html.Div([
+                html.Label("Select Country:"),
+                dcc.Dropdown(
+                    id='country-dropdown',
+                    options=[{'label': country, 'value': country} for country in countries],
+                    value=countries[0] if len(countries) else None,  # Default value
+                    clearable=False
+                )
+            ], style={'width': '20%', 'display': 'inline-block', 'marginLeft': '2%'})  # Adjust margin for spacing
+        ], style={'marginBottom': '30px'}),
+
+        # Graph with custom width
+        dcc.Graph(
+            id='line-chart',
+            style={'width': '90%', 'margin': '0 auto'}
+        )
+    ], style={'backgroundColor': '#f0f0f0', 'padding': '20px'})
+
 
+def timeline_app(server=True, url_base_pathname='/'):
+    app_timeline = Dash(__name__, server=server, url_base_pathname=url_base_pathname)
+    app_timeline.validation_layout = timeline_layout(sectors=[], countries=[])
+    app_timeline.layout = timeline_layout
+
+    # Callback to update the graph based on selected sector and country
+    app_timeline.callback(
+        Output('line-chart', 'figure'),
+        [Input('sector-dropdown', 'value'),
+         Input('country-dropdown', 'value')]
+    )(update_graph)
+    return app_timeline
 
-# Callback to update the graph based on selected sector and country
-@app_timeline.callback(
-    Output('line-chart', 'figure'),
-    [Input('sector-dropdown', 'value'),
-     Input('country-dropdown', 'value')]
-)
 def update_graph(selected_sector, selected_country):
-    # Filter DataFrame based on selected sector and country
-    filtered_df = df_analysis[(df_analysis['Industry'] == selected_sector) & (df_analysis['Country'] == selected_country)]
+    return timeline_figure(selected_sector, selected_country)
+
+
+@lru_cache(maxsize=figure_cache_size)
+def timeline_figure(selected_sector, selected_country):
+    # Select the rows for the selected sector and country
+    eu_join_year = load_timeline_data()[2]
+    filtered_df = load_timeline_selection(selected_sector, selected_country)
 
     # Plotly Express line chart
     fig = px.line(
@@ -231,10 +278,8 @@ def update_graph(selected_sector, selected_country):
     )
 
     # Keep axis range more stable:
-    fig.update_yaxes(range=[0, 1.2 * max([max(pd.unique(df_analysis.loc[(df_analysis['Country'] == selected_country) & (
-                df_analysis['Industry'] == selected_sector), 'Exports in/out EU'])),
-                                          max(pd.unique(df_analysis.loc[(df_analysis['Country'] == selected_country) & (
-                                                      df_analysis['Industry'] == selected_sector), 'Imports in/out EU']))])])
+    if not filtered_df.empty:
+        fig.update_yaxes(range=[0, 1.2 * filtered_df[['Exports in/out EU', 'Imports in/out EU']].max().max()])
 
     fig.update_layout(margin=dict(l=50, r=50, t=80, b=60))
     fig.update_yaxes(title="")
@@ -252,4 +297,11 @@ def update_graph(selected_sector, selected_country):
                           fillcolor="green", opacity=0.10, line_width=0,
                           annotation=dict(font_size=15, font_color="green"))
 
-    return fig
\ No newline at end of file
+    return fig
+
+def precompute_timeline_figures():
+    # figure of the default selection of the dropdowns (loads the data, called by dashboard.preload)
+    sectors, countries = load_timeline_data()[:2]
+    timeline_figure(sectors[0], countries[0])
+
+app_timeline = timeline_app()
@@ -1,34 +1,29 @@
 """
 This file builds a dataframe with yearly information of EU/Euro membership for different countries
-by scraping the data from wikipedia. The above defined function are used to build a dataset
-containing the membership status in EU/Eurozone for countries between 1995 and 2000
+from tables scraped from wikipedia (stored locally and only refreshed on request). The functions
+below are used to build a dataset containing the membership status in EU/Eurozone for countries
+between 1995 and 2000.
 """
 
+import os, sys, time
 from bs4 import BeautifulSoup
 import requests
+import numpy as np
 import pandas as pd
 from io import StringIO
-import pycountry
+from codes import iso2_to_iso3, iso3_to_name as iso3_to_country
+    # vectorized, for whole columns
 
 import plotly.express as px
 import plotly.io as pio
 pio.templates.default = "seaborn"
 
-def iso2_to_iso3(code):
-    try:
-        return pycountry.countries.get(alpha_2=code).alpha_3
-    except:
-        pass
-
-def iso3_to_country(code):
-    try:
-        return pycountry.countries.get(alpha_3=code).name
-    except AttributeError:
-        pass
-
 def table_to_df(url):
     response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
+    return html_to_df(response.text)
+
+def html_to_df(html):
+    soup = BeautifulSoup(html, 'html.parser')
         # parse the webpage using BeautifulSoup
     table = soup.find('table', {'class': 'wikitable'})
     html_string = str(table)
@@ -37,7 +32,7 @@ def table_to_df(url):
     df = df.rename(columns={df.columns[0]: 'Country', df.columns[1]: 'Country Code', df.columns[2]: 'Year'}
                      ).replace(r'\[.+\]', '', regex=True)[['Country','Country Code','Year']]
         # clean table of footnotes and rename columns
-    df['Country Code'] = df['Country Code'].apply(iso2_to_iso3)
+    df['Country Code'] = iso2_to_iso3(df['Country Code'])
     return df
 
 def country_year_dataframe(df_info,cat_var):
@@ -45,44 +40,141 @@ def country_year_dataframe(df_info,cat_var):
     countries = pd.unique(df_info['Country Code'])
     years = list(range(min(pd.unique(df_info['Year'])), 2021))
 
-    cut_off_info = df_info.set_index('Country Code')['Year'].to_dict()
-        # creates dictionary with year of accession per country
-
     country_year_pairs = pd.MultiIndex.from_product(
         [countries, years],
         names=['Country Code', 'Year']
     ).to_frame(index=False)
 
-    df_target = pd.merge(df_info, country_year_pairs, how='outer')
-    df_target[cat_var] = 'No'
-
-    for c in pd.unique(df_target['Country Code']):
-        df_target.loc[(df_target['Country Code'] == c) & (df_target['Year'] >= cut_off_info[c]), cat_var] = 'Yes'
-    df_target.loc[(df_target['Country Code'] == 'GBR') & (df_target['Year']==2020), cat_var] = 'No'
+    df_target = pd.merge(df_info[['Country','Country Code','Year']], country_year_pairs, how='outer')
+    df_target[cat_var] = np.where(is_member(cat_var, df_target['Country Code'], df_target['Year'],
+                                            intervals_from_table(df_info, cat_var)), 'Yes', 'No')
+        # cat_var is the zone ('EU' or 'Euro'), exits (e.g. GBR in 2020) come from membership_exits
     return df_target
 
-def get_wiki_table(zone):
+# The membership tables are read from a local store, so no network access is needed:
+# ../temp/membership.csv holds the last refreshed tables, ../assets/membership.csv is the snapshot shipped with the project
+wiki_urls = {'EU': "https://en.wikipedia.org/wiki/Member_state_of_the_European_Union",
+             'Euro': "https://en.wikipedia.org/wiki/Eurozone"}
+membership_snapshot = '../assets/membership.csv'
+membership_store = '../temp/membership.csv'
+membership_ttl = None
+    # maximum age of the store in seconds before it is refreshed from wikipedia (None: only refresh explicitly),
+    # read at every call, a ttl passed to the functions below overrides it (float('inf'): never refresh)
+
+def clean_wiki_table(wiki_table, zone):
     if zone == 'EU':
-        # scrap info from wikipedia about EU:
-        url_eu = "https://en.wikipedia.org/wiki/Member_state_of_the_European_Union"
-        wiki_eu = table_to_df(url_eu)
         # manually add the UK (no longer in Wikipedia table):
-        wiki_eu = pd.concat([wiki_eu, pd.DataFrame(
+        wiki_eu = pd.concat([wiki_table, pd.DataFrame(
             {'Country': ['United Kingdom'], 'Country Code': ['GBR'], 'Year': ['1 January 1973']})], ignore_index=True)
         # adjust the table for own needs:
         wiki_eu.replace({'Founder': '1 January 1958'}, inplace=True)
+        wiki_eu['Date'] = pd.to_datetime(wiki_eu['Year'].str.strip(), format='%d %B %Y', errors='coerce')
+            # accession date (e.g. 1 May 2004), the membership lookups work at monthly granularity
         wiki_eu['Year'] = pd.to_numeric(wiki_eu['Year'].str[-4:])
+        wiki_eu['Date'] = wiki_eu['Date'].fillna(pd.to_datetime(wiki_eu['Year'].astype(str) + '-01-01')).dt.strftime('%Y-%m-%d')
+            # 1 January if the table only gives the year
         return wiki_eu
 
     elif zone == 'Euro':
-        url_euro = "https://en.wikipedia.org/wiki/Eurozone"
-        wiki_euro = table_to_df(url_euro).drop(20)
+        wiki_euro = wiki_table.drop(20)
         # drop last row of wikipedia table (entry "eurozone")
         wiki_euro['Year'] = pd.to_numeric(wiki_euro['Year'])
+        wiki_euro['Date'] = wiki_euro['Year'].astype(str) + '-01-01'
+            # the euro is always adopted on 1 January
         return wiki_euro
+
+def scrape_wiki_table(zone):
+    # scrap info from wikipedia (html_to_df and clean_wiki_table also work on saved pages)
+    return clean_wiki_table(table_to_df(wiki_urls[zone]), zone)
+
+def refresh_membership(store=None):
+    store = store or membership_store
+    df = pd.concat([scrape_wiki_table(zone).assign(Zone=zone) for zone in wiki_urls], ignore_index=True)
+    df = df[['Zone', 'Country', 'Country Code', 'Year', 'Date']]
+    os.makedirs(os.path.dirname(store), exist_ok=True)
+    df.to_csv(store + '.tmp', index=False)
+    os.replace(store + '.tmp', store)
+    return df
+
+def load_membership(ttl=None, store=None):
+    ttl = membership_ttl if ttl is None else ttl
+    store = store or membership_store
+    if os.path.exists(store):
+        if ttl is not None and time.time() - os.path.getmtime(store) > ttl:
+            try:
+                return refresh_membership(store)
+            except Exception as e:
+                # no connection, or the layout of the wikipedia pages changed and the tables cannot be parsed
+                print(f'Membership tables could not be refreshed ({e!r}), using the stored tables')
+        return pd.read_csv(store)
+    if ttl is not None:
+        try:
+            return refresh_membership(store)
+        except Exception as e:
+            print(f'Membership tables could not be refreshed ({e!r}), using the snapshot')
+    return pd.read_csv(membership_snapshot)
+
+def get_wiki_table(zone, ttl=None):
+    if zone in wiki_urls:
+        df = load_membership(ttl)
+        return df[df['Zone'] == zone].drop('Zone', axis=1).reset_index(drop=True)
     else:
         print('Only works for EU or Eurozone')
 
+# Membership as entry/exit intervals per country and zone:
+membership_exits = {('EU', 'GBR'): '2020-01-31'}
+    # exits are not part of the wikipedia tables
+
+def intervals_from_table(df_info, zone):
+    # entry at the accession date, stores refreshed before the dates were kept only have the year (taken as 1 January)
+    if 'Date' in df_info.columns:
+        entry = pd.to_datetime(df_info['Date'])
+    else:
+        entry = pd.to_datetime(df_info['Year'].astype(int).astype(str) + '-01-01')
+    intervals = pd.DataFrame({'Zone': zone, 'Country Code': df_info['Country Code'], 'Entry': entry,
+                              'Exit': pd.NaT}).reset_index(drop=True)
+    for (exit_zone, code), date in membership_exits.items():
+        if exit_zone == zone:
+            intervals.loc[intervals['Country Code'] == code, 'Exit'] = pd.Timestamp(date)
+    return intervals
+
+def membership_intervals(ttl=None):
+    df = load_membership(ttl)
+    return pd.concat([intervals_from_table(df[df['Zone'] == zone], zone) for zone in wiki_urls], ignore_index=True)
+
+def to_days(dates):
+    # dates as days since 1970, integer years are taken at the end of the year
+    # (a country counts as member in a year if it is a member on 31 December)
+    dates = pd.Series(dates)
+    if pd.api.types.is_integer_dtype(dates):
+        return (dates.to_numpy().astype(np.int64) - 1969).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64) - 1
+    return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype(np.int64)
+
+def is_member(zone, codes, dates, intervals=None):
+    # vectorized lookup: is the country in codes a member of zone at the date in dates (one entry per row)?
+    intervals = membership_intervals() if intervals is None else intervals
+    intervals = intervals[intervals['Zone'] == zone].sort_values(['Country Code', 'Entry'])
+    countries = pd.Index(intervals['Country Code'].unique())
+
+    codes = pd.Series(codes)
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        country = np.append(countries.get_indexer(codes.cat.categories), -1)[codes.cat.codes.to_numpy()]
+            # look up the categories only (code -1 for missing values maps to the appended -1)
+    else:
+        country = countries.get_indexer(codes)
+            # -1 for countries that were never members
+    days = to_days(dates)
+
+    offset = np.int64(1) << 32
+    interval_country = countries.get_indexer(intervals['Country Code'])
+    entry_keys = interval_country * offset + intervals['Entry'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    exit_days = intervals['Exit'].fillna(pd.Timestamp.max).to_numpy().astype('datetime64[D]').astype(np.int64)
+    position = np.searchsorted(entry_keys, country * offset + days, side='right') - 1
+        # last entry of the same country before the date (intervals are sorted by country and entry)
+    position_clipped = np.clip(position, 0, None)
+    return ((country >= 0) & (position >= 0) & (interval_country[position_clipped] == country)
+            & (days < exit_days[position_clipped]))
+
 def build_membership_df():
 
     df_eu = country_year_dataframe(get_wiki_table('EU'), 'EU')
@@ -92,7 +184,7 @@ def build_membership_df():
 
     df =  pd.merge(df_eu, df_euro.drop('Country', axis=1), on=['Year', 'Country Code'], how='left').fillna(
         'No')
-    df['Country'] = df['Country Code'].apply(iso3_to_country)
+    df['Country'] = iso3_to_country(df['Country Code'])
     return df
 
 def eu_euro_members(df_membership):
@@ -106,4 +198,9 @@ def eu_euro_members(df_membership):
     fig.update_legends(title="", orientation="h", yanchor="top", y=0.9, xanchor="left", x=0.1)
     fig.add_vrect(x0=1994.5, x1=2020.5, y0=0, y1=1, opacity=0.2)
     fig.add_annotation(x=1997, y=25, text="<i>Years in dataset</i>", showarrow=False, bgcolor=None, font={'size': 13})
-    return fig
\ No newline at end of file
+    return fig
+
+if __name__ == '__main__':
+    # refresh the stored membership tables from wikipedia: python get_eu_euro_members.py refresh
+    if sys.argv[1:] == ['refresh']:
+        print(refresh_membership())
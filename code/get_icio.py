@@ -4,22 +4,126 @@ This file downloads all available IO-Tables (1995-2010) from the OECD website
 and puts the csv files into the /data/icio/ folder
 """
 
-import requests, zipfile, io, os
+import requests, zipfile, os, json, hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import instrument
 
 url = {'1995-2000':'https://stats.oecd.org/wbos/fileview2.aspx?IDFile=d26ad811-5b58-4f0c-a4e3-06a1469e475c',
        '2001-2005':'https://stats.oecd.org/wbos/fileview2.aspx?IDFile=7cb93dae-e491-4cfd-ac67-889eb7016a4a',
        '2006-2010':'https://stats.oecd.org/wbos/fileview2.aspx?IDFile=ea165bfb-3a85-4e0a-afee-6ba8e6c16052',
        '2011-2015':'https://stats.oecd.org/wbos/fileview2.aspx?IDFile=1f791bc6-befb-45c5-8b34-668d08a1702a',
        '2016-2020':'https://stats.oecd.org/wbos/fileview2.aspx?IDFile=d1ab2315-298c-4e93-9a81-c6f2273139fe'}
+checksums = {}
+       # optional sha256 of the zip files (e.g. {'1995-2000': '3f5a...'}), checked after each download
+icio_dir = '../data/icio/'
+manifest_file = 'manifest.json'
+       # records the extracted csv files (and their size) of every bundle in the icio folder
 
-def download(url=url):
+def file_sha256(file):
+       with open(file, 'rb') as f:
+              return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def fetch(link, file, chunk_size=2**20):
+       # stream the archive to disk, a partial file from an earlier attempt is resumed with a range request
+       done = os.path.getsize(file) if os.path.exists(file) else 0
+       headers = {'Range': f'bytes={done}-'} if done else {}
+       with requests.get(link, headers=headers, stream=True, timeout=60) as r:
+              if r.status_code == 416:
+                     return
+                     # nothing left to download
+              r.raise_for_status()
+              mode = 'ab' if r.status_code == 206 else 'wb'
+                     # start from scratch if the server ignores the range request
+              with open(file, mode) as f:
+                     for chunk in r.iter_content(chunk_size):
+                            f.write(chunk)
+
+def read_manifest(path=icio_dir):
+       if os.path.exists(os.path.join(path, manifest_file)):
+              with open(os.path.join(path, manifest_file)) as f:
+                     return json.load(f)
+       return {}
+
+def write_manifest(manifest, path=icio_dir):
+       with open(os.path.join(path, manifest_file + '.tmp'), 'w') as f:
+              json.dump(manifest, f, indent=2, sort_keys=True)
+       os.replace(os.path.join(path, manifest_file + '.tmp'), os.path.join(path, manifest_file))
+
+def missing_members(entry, path=icio_dir):
+       return [member for member, size in entry['members'].items()
+               if not os.path.exists(os.path.join(path, member)) or os.path.getsize(os.path.join(path, member)) != size]
+
+def legacy_entry(bundle, path=icio_dir):
+       # bundles extracted before the manifest existed: accept them if all csv files of the period are there
+       first, last = bundle.split('-')
+       members = [f'{year}_SML.csv' for year in range(int(first), int(last) + 1)]
+       if all(os.path.exists(os.path.join(path, member)) for member in members):
+              return {'sha256': None, 'members': {member: os.path.getsize(os.path.join(path, member)) for member in members}}
+
+def zip_error(file):
+       # None for a complete zip file, otherwise the reason why it cannot be extracted
+       if not zipfile.is_zipfile(file):
+              return 'no zip file'
+       try:
+              with zipfile.ZipFile(file) as z:
+                     bad_member = z.testzip()
+       except Exception as e:
+              return repr(e)
+       if bad_member is not None:
+              return f'{bad_member} is damaged'
+
+def download_bundle(bundle, link, entry=None, path=icio_dir, checksum=None):
+       if entry is not None and not missing_members(entry, path):
+              return entry, 'already exists'
+
+       zip_file = os.path.join(path, f'{bundle}.zip')
+       if not os.path.exists(zip_file):
+              with instrument.stage('fetch', bundle=bundle):
+                     fetch(link, zip_file + '.part')
+              sha256 = file_sha256(zip_file + '.part')
+              if checksum is not None and sha256 != checksum:
+                     os.remove(zip_file + '.part')
+                     raise ValueError(f'Checksum mismatch for {bundle}: expected {checksum}, got {sha256}')
+              error = zip_error(zip_file + '.part')
+              if error:
+                     os.remove(zip_file + '.part')
+                     raise ValueError(f'Download of {bundle} is not a valid zip file ({error}), it is fetched again on the next run')
+                     # e.g. an error page or a truncated body (checked even without a checksum)
+              os.replace(zip_file + '.part', zip_file)
+       else:
+              sha256 = file_sha256(zip_file)
+                     # archive is left over from an interrupted extraction
+
+       try:
+              with zipfile.ZipFile(zip_file) as z, instrument.stage('extract', bundle=bundle):
+                     members = {info.filename: info.file_size for info in z.infolist() if info.filename.endswith('_SML.csv')}
+                     entry = {'sha256': sha256, 'members': members}
+                     for member in missing_members(entry, path):
+                            z.extract(member, path)
+                            # only the needed csv files are extracted
+       except Exception:
+              os.remove(zip_file)
+              raise
+              # a damaged archive is downloaded again on the next run
+       os.remove(zip_file)
+       return entry, 'downloaded'
+
+def download(url=url, path=icio_dir, checksums=checksums, max_workers=5):
+       os.makedirs(path, exist_ok=True)
+       manifest = read_manifest(path)
        counter = 1
-       for year,link in url.items():
-              if os.path.exists(f'../data/icio/{year.split('-')[0]}_SML.csv'):
-                     print(f"Data for {year} already exists (file {counter}/{len(url)})")
-              else:
-                     r = requests.get(link)
-                     z = zipfile.ZipFile(io.BytesIO(r.content))
-                     z.extractall('../data/icio/')
-                     print(f"Data for {year} downloaded (file {counter}/{len(url)})")
-              counter += 1
\ No newline at end of file
+       with ThreadPoolExecutor(max_workers=max_workers) as pool:
+              futures = {pool.submit(download_bundle, year, link, manifest.get(year) or legacy_entry(year, path),
+                                     path, checksums.get(year)): year for year, link in url.items()}
+              for future in as_completed(futures):
+                     year = futures[future]
+                     try:
+                            manifest[year], status = future.result()
+                     except Exception as e:
+                            print(f"Data for {year} failed: {e!r} (file {counter}/{len(url)})")
+                     else:
+                            write_manifest(manifest, path)
+                                   # a bundle only enters the manifest once all its files are extracted
+                            print(f"Data for {year} {status} (file {counter}/{len(url)})")
+                     counter += 1
+       return manifest
@@ -0,0 +1,127 @@
+"""
+This file records where the time goes when the data is prepared and analysed (opt-in, off by default).
+The other modules mark their stages with instrument.stage(...), every stage records wall time, CPU time,
+peak memory (RSS) and the number of rows, nested stages and years are kept in the record.
+The records can be written as run reports (JSON and CSV), chosen stages can also be profiled with cProfile.
+Stages in worker processes (build_dataset_parallel, the parallel regressions) are not recorded,
+and the peak memory of stages that run at the same time in different threads (get_icio) is not separated.
+
+Usage (e.g. in the notebook):
+    import instrument
+    instrument.enable(profile=['collapse_row'])
+    build_dataset(...)
+    instrument.write_report()
+"""
+
+import os, sys, json, time, threading, cProfile
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:
+    resource = None
+import pandas as pd
+
+enabled = False
+profile_stages = set()
+    # names of the stages that are run under cProfile (one .prof file per call)
+report_dir = '../temp/reports/'
+records = []
+_local = threading.local()
+    # stack of the open stages of each thread (nesting and year of the inner stages)
+_disabled = nullcontext({})
+    # returned when instrumentation is off, the dictionary swallows the row counts
+_profiling = False
+
+def enable(profile=(), path=report_dir):
+    global enabled, profile_stages, report_dir
+    enabled, profile_stages, report_dir = True, set(profile), path
+    records.clear()
+
+def disable():
+    global enabled
+    enabled = False
+
+# Peak memory: on Linux the peak RSS (VmHWM) is reset at the start of each stage,
+# elsewhere the peak of the process so far is reported
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return None
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def stage(name, year=None, **info):
+    # usage: with instrument.stage('read_csv', year) as record: ... record['rows'] = len(df)
+    if not enabled:
+        return _disabled
+    return _stage(name, year, info)
+
+@contextmanager
+def _stage(name, year, info):
+    global _profiling
+    stack = _local.__dict__.setdefault('stack', [])
+    parent = stack[-1] if stack else None
+    record = {'stage': name, 'path': '/'.join([s['stage'] for s in stack] + [name]),
+              'year': year if year is not None or parent is None else parent['year'], 'rows': None, **info}
+    stack.append(record)
+    profiler = None
+    if name in profile_stages and not _profiling:
+        profiler, _profiling = cProfile.Profile(), True
+    _reset_peak_rss()
+    record['_children_peak'] = 0
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+            _profiling = False
+        record['wall_s'] = time.perf_counter() - start_wall
+        record['cpu_s'] = time.process_time() - start_cpu
+        peak = _peak_rss()
+        children_peak = record.pop('_children_peak')
+        record['peak_rss_mb'] = None if peak is None else max(peak, children_peak) / 2**20
+            # the inner stages reset the peak, so their maximum is carried up to this stage
+        stack.pop()
+        if parent is not None and peak is not None:
+            parent['_children_peak'] = max(parent['_children_peak'], peak, children_peak)
+        if profiler:
+            os.makedirs(report_dir, exist_ok=True)
+            record['profile'] = os.path.join(report_dir, f"{name}_{record['year']}_{len(records)}.prof")
+            profiler.dump_stats(record['profile'])
+                # open with: python -m pstats <file> or snakeviz
+        records.append(record)
+
+# Run reports:
+def report():
+    return pd.DataFrame(records, columns=['path', 'stage', 'year', 'rows', 'wall_s', 'cpu_s', 'peak_rss_mb'] +
+                        sorted({k for r in records for k in r} - {'path', 'stage', 'year', 'rows', 'wall_s', 'cpu_s', 'peak_rss_mb'}))
+
+def summary():
+    # total time, largest peak and all rows per stage
+    return report().groupby('path', sort=False).agg(calls=('stage', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+                                                    peak_rss_mb=('peak_rss_mb', 'max'), rows=('rows', 'sum'))
+
+def write_report(name=None, path=None):
+    path = path or report_dir
+    name = name or time.strftime('run_%Y%m%d_%H%M%S')
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f'{name}.json'), 'w') as f:
+        json.dump({'run': name, 'argv': sys.argv, 'python': sys.version.split()[0], 'pandas': pd.__version__,
+                   'stages': records}, f, indent=2, default=str)
+    report().to_csv(os.path.join(path, f'{name}.csv'), index=False)
+    return os.path.join(path, f'{name}.json')
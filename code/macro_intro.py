@@ -1,33 +1,66 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import eurostat
-import pycountry
+from codes import iso2_to_name as iso2_to_country
+    # vectorized, for whole columns
 
 import plotly.express as px
 import plotly.io as pio
 pio.templates.default = "seaborn"
 
-def iso2_to_country(code):
-    # used in following function
-    try:
-        return pycountry.countries.get(alpha_2=code).name
-    except AttributeError:
-        pass
-
-def get_macro_data():
-    # Download inflation data
-    df = eurostat.get_data_df('prc_hicp_manr')
+# Reshape the downloaded tables (one column per month) into long format:
+def inflation_long(df):
     inflation = df[df['coicop'] == 'CP00'].drop(['freq','unit','coicop'],axis=1).rename(columns={r'geo\TIME_PERIOD':'Country ISO2'})
-    inflation = inflation.set_index('Country ISO2').stack().reset_index().rename(columns={'level_1':'Date',0:'Inflation'})
+    return inflation.set_index('Country ISO2').stack().reset_index().rename(columns={'level_1':'Date',0:'Inflation'})
 
-    # Download unemployment data
-    df = eurostat.get_data_df('ei_lmhr_m')
+def unemployment_long(df):
     unemployment = df[(df['indic']=='LM-UN-T-TOT')&(df['s_adj']=='NSA')].drop(['freq','unit','s_adj','indic'],axis=1).rename(columns={r'geo\TIME_PERIOD':'Country ISO2'})
-    unemployment = unemployment.set_index('Country ISO2').stack().reset_index().rename(columns={'level_1':'Date',0:'Unemployment'})
+    return unemployment.set_index('Country ISO2').stack().reset_index().rename(columns={'level_1':'Date',0:'Unemployment'})
+
+def interest_long(df):
+    interest = df.drop(['freq','int_rt'],axis=1).rename(columns={r'geo\TIME_PERIOD':'Country ISO2'})
+    return interest.set_index('Country ISO2').stack().reset_index().rename(columns={'level_1':'Date',0:'Long-Term Interest Rate'})
+
+macro_datasets = {'prc_hicp_manr': inflation_long,   # inflation
+                  'ei_lmhr_m': unemployment_long,    # unemployment
+                  'irt_lt_mcby_m': interest_long}    # interest rate
+macro_cache_dir = '../temp/eurostat/'
+macro_refetch_months = 3
+    # months before the last month of every country that are downloaded again (Eurostat revises recent values)
+
+def eurostat_fetch(code, start=None):
+    # default backend, start: first month to download ('YYYY-MM'), None for the whole series
+    if start is None:
+        return eurostat.get_data_df(code)
+    return eurostat.get_data_df(code, filter_pars={'startPeriod': start})
+
+def update_dataset(code, fetch=eurostat_fetch, cache_dir=macro_cache_dir):
+    # only download the recent months (from the earliest last month of the countries) and add them to the cache
+    cache_file = os.path.join(cache_dir, f'{code}.csv')
+    cached = pd.read_csv(cache_file, keep_default_na=False, na_values=['']) if os.path.exists(cache_file) else None
+        # keep_default_na=False: 'NA' (Namibia) is a valid country code
+    start = None
+    if cached is not None and len(cached):
+        start = str(pd.Period(cached.groupby('Country ISO2')['Date'].max().min(), freq='M') + 1 - macro_refetch_months)
+            # countries that lag behind get their missing months (missing cells are not cached), newer values replace the cached ones
+    df = fetch(code, start)
+    if df is None or len(df) == 0:
+        return cached
+    new = macro_datasets[code](df)
+    if cached is not None:
+        new = pd.concat([cached, new]).drop_duplicates(['Country ISO2', 'Date'], keep='last')
+    new = new.sort_values(['Country ISO2', 'Date']).reset_index(drop=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    new.to_csv(cache_file + '.tmp', index=False)
+    os.replace(cache_file + '.tmp', cache_file)
+    return new
 
-    # Download interest rate data
-    df = eurostat.get_data_df('irt_lt_mcby_m').drop(['freq','int_rt'],axis=1).rename(columns={r'geo\TIME_PERIOD':'Country ISO2'})
-    interest = df.set_index('Country ISO2').stack().reset_index().rename(columns={'level_1':'Date',0:'Long-Term Interest Rate'})
+def get_macro_data(fetch=eurostat_fetch, cache_dir=macro_cache_dir):
+    # Download inflation, unemployment and interest rate data at the same time
+    with ThreadPoolExecutor(max_workers=len(macro_datasets)) as pool:
+        inflation, unemployment, interest = pool.map(lambda code: update_dataset(code, fetch, cache_dir), macro_datasets)
 
     # Merge all indicators together
     macro_df = pd.merge(pd.merge(inflation,unemployment,on=['Country ISO2','Date']),interest,on=['Country ISO2','Date'])
@@ -36,7 +69,7 @@ def get_macro_data():
     macro_df['Date'] = pd.to_datetime(macro_df['Date'], format="%Y-%m")
 
     # Add country names
-    macro_df['Country'] = macro_df['Country ISO2'].apply(iso2_to_country)
+    macro_df['Country'] = iso2_to_country(macro_df['Country ISO2'])
     macro_df = macro_df[~macro_df['Country'].isna()]
         # drop non-countries (e.g. aggregate EU data)
     macro_df.drop('Country ISO2', axis=1, inplace=True)
@@ -1,21 +1,27 @@
 from dash import Dash, dcc, html, Input, Output
-import pandas as pd
 import datetime
+from functools import lru_cache
 
 import plotly.express as px
 import plotly.io as pio
 pio.templates.default = "seaborn"
 
-macro_df = pd.read_csv('../temp/macro-data.csv')
-macro_df_agg = macro_df.drop('Country', axis=1).groupby(['Country Group', 'Date']).mean().reset_index()
-for ind in ['Inflation', 'Unemployment', 'Long-Term Interest Rate']:
-    macro_df_agg[ind] = macro_df_agg[ind] / 100
+from store import read_dataset
 
-# Initialize the Dash app
-app_macro = Dash(__name__)
+macro_file = '../temp/macro-data.csv'
+    # read through the Parquet dataset next to the csv file (see store.py)
+macro_indicators = ['Inflation', 'Unemployment', 'Long-Term Interest Rate']
+
+# The data of an indicator is read (only its column) and aggregated on first use:
+@lru_cache(maxsize=None)
+def load_macro_data(indicator):
+    macro_df = read_dataset(macro_file, columns=['Country Group', 'Date', indicator])
+    macro_df_agg = macro_df.groupby(['Country Group', 'Date'], observed=True).mean().reset_index()
+    macro_df_agg[indicator] = macro_df_agg[indicator] / 100
+    return macro_df_agg
 
 # Layout for the Dash App
-app_macro.layout = html.Div([
+macro_layout = html.Div([
     html.H1("Macro indicators for different country groups in Europe", style={'padding-left': '5%'}),
 
     # Dropdown for Indicator Selection
@@ -39,16 +45,29 @@ app_macro.layout = html.Div([
 ], style={'backgroundColor': '#f0f0f0', 'padding': '20px'})
 
 
-# Callback to update the graph based on selected indicator
-@app_macro.callback(
-    Output('line-chart', 'figure'),
-    Input('indicator-dropdown', 'value')
-)
+def macro_app(server=True, url_base_pathname='/'):
+    # server: flask server to attach the app to (True creates its own), url_base_pathname: route of the app on it
+    app_macro = Dash(__name__, server=server, url_base_pathname=url_base_pathname)
+    app_macro.layout = macro_layout
+
+    # Callback to update the graph based on selected indicator
+    app_macro.callback(
+        Output('line-chart', 'figure'),
+        Input('indicator-dropdown', 'value')
+    )(update_graph)
+    return app_macro
+
 def update_graph(indicator):
+    return macro_figure(indicator)
+
+
+# Figures are cached by their inputs (macro_figure.cache_info() shows hits and misses):
+@lru_cache(maxsize=None)  # only three indicators
+def macro_figure(indicator):
 
     # Plotly Express line chart
     fig = px.line(
-        macro_df_agg.reset_index(),
+        load_macro_data(indicator),
         x='Date',
         y=indicator,
         color='Country Group',
@@ -68,4 +87,6 @@ def update_graph(indicator):
     fig.update_yaxes(title="")
     fig.update_legends(title="", orientation="h", yanchor="top", y=1.1, xanchor="left", x=0.02)
 
-    return fig
\ No newline at end of file
+    return fig
+
+app_macro = macro_app()
\ No newline at end of file
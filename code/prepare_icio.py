@@ -3,42 +3,369 @@ The functions in this file use the csv files containing the IO-table for one yea
 and turn it into a dataframe with the necessary structure and labels for the analysis.
 """
 
+import os, re, csv, glob, hashlib
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:
+    resource = None
+        # not available on Windows (no memory limit for the workers there)
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
-def icio_to_dataframe(file):
-    data = pd.read_csv(file)
+from get_eu_euro_members import is_member, membership_intervals
+import instrument
 
-    data.drop(data.filter(regex='T$|NPISH$|GGFC$|GFCF$|INVNT$|DPABR$').columns, axis=1, inplace=True)
-        # drop columns on non-household final demand and households as employers (quantitatively irrelevant)
-    data = data[~data['V1'].isin(['TLS','VA','OUT'])]
-        # drop last three rows (taxes, value added, output)
-    data[['Country Code','Industry Code']] = data['V1'].str.split(pat="_",n=1,expand=True)
+drop_columns = 'T$|NPISH$|GGFC$|GFCF$|INVNT$|DPABR$'
+    # columns on non-household final demand and households as employers (quantitatively irrelevant)
+drop_rows = ['TLS','VA','OUT']
+    # last three rows (taxes, value added, output)
+csv_backend = 'arrow'
+    # 'arrow' (multithreaded pyarrow.csv, only the kept columns and rows) or 'pandas' (pd.read_csv)
+icio_dir = '../data/icio/'
+cache_dir = '../temp/icio_cache/'
+dataset_file = '../results/full_dataset.csv'
+
+# Fixed vocabularies of the ICIO tables (2023 edition) for the compact (categorical) schema:
+icio_countries = ['ARG', 'AUS', 'AUT', 'BEL', 'BGD', 'BGR', 'BLR', 'BRA', 'BRN', 'CAN', 'CHE', 'CHL', 'CHN', 'CIV',
+                  'CMR', 'COL', 'CRI', 'CYP', 'CZE', 'DEU', 'DNK', 'EGY', 'ESP', 'EST', 'FIN', 'FRA', 'GBR', 'GRC',
+                  'HKG', 'HRV', 'HUN', 'IDN', 'IND', 'IRL', 'ISL', 'ISR', 'ITA', 'JOR', 'JPN', 'KAZ', 'KHM', 'KOR',
+                  'LAO', 'LTU', 'LUX', 'LVA', 'MAR', 'MEX', 'MLT', 'MMR', 'MYS', 'NGA', 'NLD', 'NOR', 'NZL', 'PAK',
+                  'PER', 'PHL', 'POL', 'PRT', 'ROU', 'RUS', 'SAU', 'SEN', 'SGP', 'SVK', 'SVN', 'SWE', 'THA', 'TUN',
+                  'TUR', 'TWN', 'UKR', 'USA', 'VNM', 'ZAF', 'ROW']
+icio_industries = ['A01_02', 'A03', 'B05_06', 'B07_08', 'B09', 'C10T12', 'C13T15', 'C16', 'C17_18', 'C19', 'C20',
+                   'C21', 'C22', 'C23', 'C24', 'C25', 'C26', 'C27', 'C28', 'C29', 'C30', 'C31T33', 'D', 'E', 'F', 'G',
+                   'H49', 'H50', 'H51', 'H52', 'H53', 'I', 'J58T60', 'J61', 'J62_63', 'K', 'L', 'M', 'N', 'O', 'P',
+                   'Q', 'R', 'S', 'T']
+country_dtype = pd.CategoricalDtype(sorted(icio_countries))
+    # shared by 'Country Code' and 'Trade Country Code'
+sector_dtype = pd.CategoricalDtype(sorted(set(icio_industries) | {i[0] for i in icio_industries} | {'HFCE'}))
+    # shared by 'Industry Code' and 'Trade Sector' (incl. aggregated industries and household consumption)
+    # categories are sorted so that groupbys return the same order as with strings
+
+def icio_to_dataframe(file,backend=None):
+    backend = backend or csv_backend
+        # the module setting is read at every call
+    with instrument.stage('read_csv', backend=backend) as record:
+        if backend == 'arrow':
+            data = read_csv_arrow(file)
+        else:
+            data = pd.read_csv(file)
+            data.drop(data.filter(regex=drop_columns).columns, axis=1, inplace=True)
+            data = data[~data['V1'].isin(drop_rows)]
+        record['rows'] = len(data)
+    with instrument.stage('split labels'):
+        data[['Country Code','Industry Code']] = data['V1'].str.split(pat="_",n=1,expand=True)
+    return data
+
+def read_csv_arrow(file):
+    # multithreaded pyarrow reader: only the columns that are kept are parsed (as float64) and the
+    # dropped rows are removed before the table is converted to pandas
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv, compute as pc
+    with open(file, newline='') as f:
+        header = next(csv.reader(f))
+    columns = [c for c in header if c == 'V1' or not re.search(drop_columns, c)]
+        # same columns as data.filter(regex=drop_columns) in the pandas backend
+    table = pa_csv.read_csv(file,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=max(2**20, os.path.getsize(file) // pa.cpu_count() + 1)),
+            # one block per thread: many small blocks of a table with thousands of columns are slow to put together
+        convert_options=pa_csv.ConvertOptions(include_columns=columns,
+                                              column_types={c: pa.string() if c == 'V1' else pa.float64() for c in columns}))
+    table = table.filter(pc.invert(pc.is_in(table['V1'], pa.array(drop_rows))))
+    return table.to_pandas()
+
+# Cache the cleaned tables as feather files (parsing the csv files is the slowest step):
+def file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def cached_icio_to_dataframe(file, cache_dir=cache_dir, backend=None):
+    backend = backend or csv_backend
+    key = hashlib.sha256('|'.join([file_hash(file), drop_columns, backend] + drop_rows).encode()).hexdigest()[:16]
+        # a changed csv file, changed drop rules or another backend (different dtypes) lead to a new key and thus a rebuild
+    name = os.path.splitext(os.path.basename(file))[0]
+    cache_file = os.path.join(cache_dir, f'{name}_{backend}_{key}.feather')
+    if os.path.exists(cache_file):
+        with instrument.stage('read cache') as record:
+            data = pd.read_feather(cache_file)
+            record['rows'] = len(data)
+        return data
+
+    data = icio_to_dataframe(file,backend).reset_index(drop=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_file in glob.glob(os.path.join(cache_dir, f'{name}_{backend}_*.feather')):
+        os.remove(old_file)
+        # remove outdated versions of the same table (each backend keeps its own)
+    data.to_feather(cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+        # write to a temporary file first so that an interrupted run leaves no broken cache
     return data
 
-def wide_to_long(data,var,year):
-    df_source = data.melt(id_vars=['V1','Country Code','Industry Code'],
-          var_name='Partner', value_name=var)
-    df_source[['Trade Country Code','Trade Sector']] = df_source['Partner'].str.split(pat="_",n=1,expand=True)
+def to_category(values,dtype):
+    categorical = pd.Categorical(values, dtype=dtype)
+    unknown = pd.isna(categorical) & ~pd.isna(values)
+    if unknown.any():
+        raise ValueError(f'Codes not in the fixed vocabulary: {sorted(set(np.asarray(values)[unknown]))}')
+    return categorical
+
+def wide_to_long(data,var,year,compact=False,float32=False):
+    if compact:
+        return wide_to_long_compact(data,var,year,float32)
+    with instrument.stage('melt') as record:
+        df_source = data.melt(id_vars=['V1','Country Code','Industry Code'],
+              var_name='Partner', value_name=var)
+        record['rows'] = len(df_source)
+    with instrument.stage('split labels'):
+        df_source[['Trade Country Code','Trade Sector']] = df_source['Partner'].str.split(pat="_",n=1,expand=True)
     df_source.drop('Partner',axis=1,inplace=True)
     df_source['Year'] = year
     return df_source
 
+def wide_to_long_compact(data,var,year,float32=False):
+    # same frame as wide_to_long, but codes are categoricals built directly from the (few) row and column labels
+    partners = data.columns.drop(['V1','Country Code','Industry Code'])
+    partner_codes = partners.str.split(pat="_", n=1, expand=True)
+    values = data[partners].to_numpy()
+    if float32:
+        values = values.astype(np.float32)
+    n_rows, n_partners = values.shape
+    return pd.DataFrame({
+        'V1': pd.Categorical.from_codes(np.tile(np.arange(n_rows), n_partners), categories=data['V1']),
+        'Country Code': pd.Categorical.from_codes(np.tile(to_category(data['Country Code'], country_dtype).codes, n_partners),
+                                                  dtype=country_dtype),
+        'Industry Code': pd.Categorical.from_codes(np.tile(to_category(data['Industry Code'], sector_dtype).codes, n_partners),
+                                                   dtype=sector_dtype),
+        var: values.ravel(order='F'),
+            # column by column, as in melt
+        'Trade Country Code': pd.Categorical.from_codes(
+            np.repeat(to_category(partner_codes.get_level_values(0), country_dtype).codes, n_rows), dtype=country_dtype),
+        'Trade Sector': pd.Categorical.from_codes(
+            np.repeat(to_category(partner_codes.get_level_values(1), sector_dtype).codes, n_rows), dtype=sector_dtype),
+        'Year': np.full(n_rows * n_partners, year, dtype=np.int16)})
+
+def compact_schema(df,float32=False):
+    # turn an existing long frame into the compact schema
+    df = df.copy()
+    for col, dtype in [('Country Code', country_dtype), ('Trade Country Code', country_dtype),
+                       ('Industry Code', sector_dtype), ('Trade Sector', sector_dtype)]:
+        if col in df.columns:
+            df[col] = to_category(df[col], dtype)
+    if 'Year' in df.columns:
+        df['Year'] = df['Year'].astype(np.int16)
+    if float32:
+        df = df.astype({col: np.float32 for col in df.select_dtypes('float64').columns})
+    return df
+
 def collapse_row(df_source,members):
-    df_source.loc[~df_source['Country Code'].isin(members), 'Country Code'] = 'ROW'
-    df_source.loc[~df_source['Trade Country Code'].isin(members), 'Trade Country Code'] = 'ROW'
-        # sum up sales/imports for all non-eu countries
-    df_source.loc[df_source['Industry Code'].str[0] != 'C', 'Industry Code'] = df_source[df_source['Industry Code'].str[0] != 'C']['Industry Code'].str[0]
-        # aggregate all industry codes except C (manufacturing)
-    return df_source.drop('V1', axis=1).groupby(
-        ['Country Code', 'Industry Code', 'Trade Country Code', 'Trade Sector', 'Year'], as_index=False).sum()
+    with instrument.stage('relabel'):
+        df_source.loc[~df_source['Country Code'].isin(members), 'Country Code'] = 'ROW'
+        df_source.loc[~df_source['Trade Country Code'].isin(members), 'Trade Country Code'] = 'ROW'
+            # sum up sales/imports for all non-eu countries
+        df_source.loc[df_source['Industry Code'].str[0] != 'C', 'Industry Code'] = df_source[df_source['Industry Code'].str[0] != 'C']['Industry Code'].str[0]
+            # aggregate all industry codes except C (manufacturing)
+    with instrument.stage('groupby') as record:
+        df_short = df_source.drop('V1', axis=1).groupby(
+            ['Country Code', 'Industry Code', 'Trade Country Code', 'Trade Sector', 'Year'], as_index=False, observed=True).sum()
+            # observed=True: only combinations present in the data for categorical codes
+        record['rows'] = len(df_short)
+    return df_short
+
+# Dense alternative to collapse_row(wide_to_long(data,var,year),members):
+# the year stays a (country-industry x partner) array and is aggregated via A*Z*B' before turning it into long format
+# (sums can differ from the groupby in the last digits because of the summation order)
+def aggregation_matrix(keys):
+    codes, groups = pd.factorize(pd.MultiIndex.from_arrays(keys), sort=True)
+    valid = codes >= 0
+        # labels with missing parts are dropped (as in groupby)
+    matrix = sparse.csr_matrix((np.ones(valid.sum()), (codes[valid], np.flatnonzero(valid))),
+                               shape=(len(groups), len(codes)))
+    return matrix, groups
+
+def collapse_row_dense(data,members,var,year,compact=False,float32=False):
+    partners = data.columns.drop(['V1','Country Code','Industry Code'])
+    values = data[partners].to_numpy()
+    dtype = values.dtype
+    values = np.nan_to_num(values.astype(float), copy=False)
+
+    country = data['Country Code'].where(data['Country Code'].isin(members), 'ROW')
+    industry = data['Industry Code'].where(data['Industry Code'].str[0] == 'C', data['Industry Code'].str[0])
+        # same relabelling as in collapse_row
+    partner_codes = partners.str.split(pat="_", n=1, expand=True)
+    trade_country = partner_codes.get_level_values(0).where(partner_codes.get_level_values(0).isin(members), 'ROW')
+    row_matrix, row_groups = aggregation_matrix([country, industry])
+    col_matrix, col_groups = aggregation_matrix([trade_country, partner_codes.get_level_values(1)])
+
+    collapsed = row_matrix @ values @ col_matrix.T
+        # groups come out sorted, so the long format has the same order as the groupby in collapse_row
+    n_rows, n_cols = collapsed.shape
+    df_short = pd.DataFrame({
+        'Country Code': np.repeat(row_groups.get_level_values(0), n_cols),
+        'Industry Code': np.repeat(row_groups.get_level_values(1), n_cols),
+        'Trade Country Code': np.tile(col_groups.get_level_values(0), n_rows),
+        'Trade Sector': np.tile(col_groups.get_level_values(1), n_rows),
+        'Year': year,
+        var: np.asarray(collapsed).ravel().astype(dtype)})
+    return compact_schema(df_short,float32) if compact else df_short
 
 def classify_trade(df_short,targets,var):
-    df_short[var] = 0
-    df_short.loc[(df_short['Country Code'].isin(targets)) &
-                 (df_short['Trade Country Code'].isin(targets)) &
-                 (df_short['Country Code'] != df_short['Trade Country Code']),var] = 1
+    # targets: list of countries or a zone ('EU'/'Euro') whose membership is looked up for the year of each row
+    compact = isinstance(df_short['Country Code'].dtype, pd.CategoricalDtype)
+    if isinstance(targets, str):
+        intervals = membership_intervals()
+        in_targets = (is_member(targets, df_short['Country Code'], df_short['Year'], intervals) &
+                      is_member(targets, df_short['Trade Country Code'], df_short['Year'], intervals))
+    else:
+        in_targets = df_short['Country Code'].isin(targets) & df_short['Trade Country Code'].isin(targets)
+    df_short[var] = (in_targets & (df_short['Country Code'] != df_short['Trade Country Code'])).astype(np.int8 if compact else np.int64)
+        # 1 for trade between two different target countries, 0 otherwise (int8 in the compact schema)
+    return df_short
+
+# Sparse alternative: most flows in the table are exactly zero, so the table is read in chunks into a
+# scipy.sparse matrix and only the non-zero flows are aggregated and returned (unless keep_zeros=True)
+def icio_to_sparse(file,chunksize=1000):
+    # same rows and columns as icio_to_dataframe, without holding the dense table in memory
+    blocks, labels = [], []
+    for chunk in pd.read_csv(file, chunksize=chunksize):
+        chunk = chunk[~chunk['V1'].isin(drop_rows)]
+        chunk = chunk.drop(chunk.filter(regex=drop_columns).columns, axis=1)
+        labels.append(chunk['V1'])
+        blocks.append(sparse.csr_matrix(np.nan_to_num(chunk.drop(columns='V1').to_numpy(dtype=float))))
+    return sparse.vstack(blocks, format='csr'), pd.Index(pd.concat(labels)), chunk.columns.drop('V1')
+
+def dataframe_to_sparse(data):
+    # for tables that are already loaded (e.g. from the feather cache)
+    partners = data.columns.drop(['V1','Country Code','Industry Code'])
+    return sparse.csr_matrix(np.nan_to_num(data[partners].to_numpy(dtype=float))), pd.Index(data['V1']), partners
+
+def sparsity_stats(matrix):
+    cells = matrix.shape[0] * matrix.shape[1]
+    return {'cells': cells, 'nonzero': matrix.nnz, 'density': matrix.nnz / cells if cells else np.nan,
+            'dense_mb': cells * matrix.dtype.itemsize / 2**20,
+            'sparse_mb': (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes) / 2**20}
+
+def collapse_row_sparse(matrix,row_labels,partners,members,var,year,keep_zeros=False,compact=False,float32=False):
+    row_codes = row_labels.str.split(pat="_", n=1, expand=True)
+    country = row_codes.get_level_values(0).where(row_codes.get_level_values(0).isin(members), 'ROW')
+    industry = row_codes.get_level_values(1).where(row_codes.get_level_values(1).str[0] == 'C',
+                                                  row_codes.get_level_values(1).str[0])
+        # same relabelling as in collapse_row
+    partner_codes = partners.str.split(pat="_", n=1, expand=True)
+    trade_country = partner_codes.get_level_values(0).where(partner_codes.get_level_values(0).isin(members), 'ROW')
+    row_matrix, row_groups = aggregation_matrix([country, industry])
+    col_matrix, col_groups = aggregation_matrix([trade_country, partner_codes.get_level_values(1)])
+
+    collapsed = (row_matrix @ matrix @ col_matrix.T).tocsr()
+    if keep_zeros:
+        rows, cols = np.divmod(np.arange(collapsed.shape[0] * collapsed.shape[1]), collapsed.shape[1])
+        values = collapsed.toarray().ravel()
+            # all groups, as in collapse_row_dense
+    else:
+        collapsed.eliminate_zeros()
+        collapsed.sort_indices()
+        coo = collapsed.tocoo()
+        rows, cols, values = coo.row, coo.col, coo.data
+            # row by row with sorted columns: same order as the other engines, without the zero flows
+    df_short = pd.DataFrame({
+        'Country Code': row_groups.get_level_values(0)[rows],
+        'Industry Code': row_groups.get_level_values(1)[rows],
+        'Trade Country Code': col_groups.get_level_values(0)[cols],
+        'Trade Sector': col_groups.get_level_values(1)[cols],
+        'Year': year,
+        var: values})
+    return compact_schema(df_short,float32) if compact else df_short
+
+def sparsity_report(years,path=icio_dir):
+    # share of non-zero flows and memory of the sparse tables for each year
+    return pd.DataFrame([{'Year': year, **sparsity_stats(icio_to_sparse(f'{path}{year}_SML.csv')[0])} for year in years])
+
+# Build the dataset for several years one year at a time (memory is bounded by a single year):
+def collapse_year(year,members,var,engine='pandas',path=icio_dir,cache=True,compact=False,float32=False,keep_zeros=False):
+    # keep_zeros: only used by the sparse engine (the other engines always return all groups)
+    with instrument.stage('collapse_year', year, engine=engine) as record:
+        file = f'{path}{year}_SML.csv'
+        if engine == 'sparse':
+            with instrument.stage('read sparse') as sparse_record:
+                matrix, row_labels, partners = dataframe_to_sparse(cached_icio_to_dataframe(file)) if cache else icio_to_sparse(file)
+                    # without the cache, the dense table is never held in memory as a whole
+                sparse_record.update(sparsity_stats(matrix))
+            with instrument.stage('collapse_row_sparse'):
+                df_short = collapse_row_sparse(matrix,row_labels,partners,members,var,year,keep_zeros,compact,float32)
+        else:
+            data = cached_icio_to_dataframe(file) if cache else icio_to_dataframe(file)
+            if engine == 'dense':
+                with instrument.stage('collapse_row_dense'):
+                    df_short = collapse_row_dense(data,members,var,year,compact,float32)
+            else:
+                with instrument.stage('wide_to_long'):
+                    df_source = wide_to_long(data,var,year,compact,float32)
+                with instrument.stage('collapse_row'):
+                    df_short = collapse_row(df_source,members)
+        record['rows'] = len(df_short)
     return df_short
 
+def collapsed_years(years,members,var,engine='pandas',path=icio_dir,cache=True,compact=False,float32=False,keep_zeros=False):
+    for year in years:
+        yield year, collapse_year(year,members,var,engine,path,cache,compact,float32,keep_zeros)
+            # the wide table of a year is released before the next year is read
+
+def append_year(df_short,flags,part_file,header):
+    # flags: dictionary with the name of each trade flag and its target countries, e.g. {'Intra-EU Trade': eu_members}
+    with instrument.stage('classify_trade'):
+        for flag, targets in flags.items():
+            df_short = classify_trade(df_short,targets,flag)
+    with instrument.stage('write_csv') as record:
+        df_short.to_csv(part_file, mode='a', header=header, index=False)
+        record['rows'] = len(df_short)
+
+def build_dataset(years,members,var,flags,out_file=dataset_file,engine='pandas',path=icio_dir,cache=True,
+                  compact=False,float32=False,keep_zeros=False):
+    years = list(years)
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    part_file = out_file + '.part'
+    if os.path.exists(part_file):
+        os.remove(part_file)
+    for counter, (year, df_short) in enumerate(collapsed_years(years,members,var,engine,path,cache,compact,float32,keep_zeros), start=1):
+        with instrument.stage('append_year', year):
+            append_year(df_short,flags,part_file,header=(counter == 1))
+                # append each year directly to the output file
+        print(f"Data for {year} added (year {counter}/{len(years)})")
+    os.replace(part_file, out_file)
+        # the output file is only replaced once all years are processed
+    return out_file
+
+# Build the dataset with several processes (one year per task):
+def limit_memory(max_memory):
+    # runs at the start of each worker process, max_memory in bytes
+    if max_memory and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+def build_dataset_parallel(years,members,var,flags,out_file=dataset_file,engine='pandas',path=icio_dir,cache=True,
+                           compact=False,float32=False,max_workers=None,max_memory=None,keep_zeros=False):
+    years = list(years)
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    part_file = out_file + '.part'
+    if os.path.exists(part_file):
+        os.remove(part_file)
+    failed = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=limit_memory, initargs=(max_memory,)) as pool:
+        futures = {year: pool.submit(collapse_year,year,members,var,engine,path,cache,compact,float32,keep_zeros) for year in years}
+        for counter, year in enumerate(years, start=1):
+            # collect the years in their original order so the output is always the same
+            try:
+                df_short = futures[year].result()
+            except Exception as e:
+                failed[year] = repr(e)
+                print(f"Data for {year} failed: {e!r} (year {counter}/{len(years)})")
+                continue
+            with instrument.stage('append_year', year):
+                append_year(df_short,flags,part_file,header=not os.path.exists(part_file))
+            print(f"Data for {year} added (year {counter}/{len(years)})")
+    if os.path.exists(part_file):
+        os.replace(part_file, out_file)
+    return failed
+
 # The data has the same shape for all years:
 # for year in range(1995, 2020):
 #     df = pd.read_csv(f'../data/icio/{year}_SML.csv')
@@ -0,0 +1,121 @@
+"""
+This file keeps the derived datasets (full_dataset.csv, df_map.csv, df_analysis.csv, macro-data.csv) as
+Parquet datasets next to their csv files (e.g. ../temp/df_map.parquet/). They are partitioned by year and
+industry (Year=.../Industry=.../), strings are stored as categories and integers downcast, and pyarrow writes
+min/max statistics for every column chunk. The readers pass filters (as in pd.read_parquet) and columns to the
+pyarrow dataset, so only the partitions and row groups that can match the filters and only the requested columns are read:
+    read_dataset('../temp/df_map.csv', filters=[('Industry', '==', 'Machinery and equipment'),
+                 ('Country Code', '==', 'POL')], columns=['Year', 'Trade Country Code', 'Sales Shares'])
+A dataset is built from its csv file on first use and again (as a new version) whenever the csv file changes.
+The list of files and partitions of a dataset is kept in memory, so that repeated reads do not scan the folders again.
+"""
+
+import os, shutil
+from functools import lru_cache
+import pandas as pd
+
+csv_chunksize = 2_000_000
+    # rows per chunk when a csv file is converted (full_dataset.csv does not fit into memory at once)
+
+def dataset_path(file):
+    return os.path.splitext(file)[0] + '.parquet'
+
+def partition_columns(df):
+    # year and industry (names if available, as filtered by the dashboards), macro-data has neither
+    columns = ['Year'] if 'Year' in df.columns else []
+    for industry in ['Industry', 'Industry Code']:
+        if industry in df.columns:
+            return columns + [industry]
+    return columns
+
+def compact_dtypes(df):
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype('category')
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+                # flags become int8, years int16 (the same in every chunk)
+    return df
+
+def source_version(file):
+    # name of the dataset version that belongs to the csv file in its current state
+    stat = os.stat(file)
+    return f'{stat.st_size}_{stat.st_mtime_ns}'
+
+def write_dataset(frames, file):
+    # frames: the dataset in one or several parts (chunks or years), file: csv file with the same content
+    # every version is written to its own folder (e.g. df_map.parquet/<size>_<mtime>/), so processes that read
+    # the dataset at the same time never see half-written or deleted files
+    path = dataset_path(file)
+    version_path = os.path.join(path, source_version(file))
+    temp_path = f'{version_path}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    for counter, df in enumerate(frames):
+        df = compact_dtypes(df.reset_index(drop=True))
+        partitions = partition_columns(df)
+        if partitions:
+            df.to_parquet(temp_path, partition_cols=partitions, index=False)
+                # every call adds new files to the partitions
+        else:
+            df.to_parquet(os.path.join(temp_path, f'part-{counter}.parquet'), index=False)
+    try:
+        os.replace(temp_path, version_path)
+    except OSError:
+        shutil.rmtree(temp_path, ignore_errors=True)
+            # another process has written the same version in the meantime
+    remove_old_versions(path, version_path)
+    return version_path
+
+def remove_old_versions(path, version_path):
+    # the previous version is kept, as another process may still be reading it (it is removed by the next conversion),
+    # older versions are no longer read (the readers look up the version of the csv file when they open the dataset)
+    entries = [os.path.join(path, entry) for entry in os.listdir(path) if not entry.endswith('.tmp')]
+    versions = sorted([entry for entry in entries if entry != version_path and os.path.isdir(entry)],
+                      key=os.path.getmtime, reverse=True)
+    for entry in versions[1:]:
+        shutil.rmtree(entry, ignore_errors=True)
+    for entry in entries:
+        if os.path.isfile(entry):
+            os.remove(entry)
+                # files of the layout before the version folders
+
+def csv_to_dataset(file):
+    return write_dataset(pd.read_csv(file, chunksize=csv_chunksize), file)
+
+def stored_dataset(file):
+    # folder of the dataset version of the csv file, converted first if it does not exist yet
+    path = dataset_path(file)
+    if not os.path.exists(file) and os.path.isdir(path):
+        versions = [os.path.join(path, v) for v in os.listdir(path) if not v.endswith('.tmp')]
+        if versions:
+            return max(versions, key=os.path.getmtime)
+                # only the dataset is available
+    version_path = os.path.join(path, source_version(file))
+    if os.path.isdir(version_path):
+        return version_path
+    return csv_to_dataset(file)
+
+@lru_cache(maxsize=None)
+def open_dataset(version_path):
+    # a rebuilt dataset has a new version folder and is discovered again
+    import pyarrow.dataset as ds
+    return ds.dataset(version_path, format='parquet', partitioning=ds.HivePartitioning.discover(infer_dictionary=True))
+
+def load_dataset(file):
+    return open_dataset(stored_dataset(file))
+
+def partition_values(file, column):
+    # values of a partition column (from the folder names, no file is read)
+    dataset = load_dataset(file)
+    return dataset.partitioning.dictionaries[dataset.partitioning.schema.names.index(column)].to_pandas()
+
+def read_dataset(file, filters=None, columns=None):
+    # filters as in pd.read_parquet, e.g. [('Year', '>=', 2004), ('Country Code', 'in', ['DEU', 'FRA'])]
+    import pyarrow.parquet as pq
+    df = load_dataset(file).to_table(columns=columns, filter=None if filters is None else pq.filters_to_expression(filters)).to_pandas()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and pd.api.types.is_integer_dtype(df[column].cat.categories):
+            df[column] = df[column].astype(df[column].cat.categories.dtype)
+                # years come back from the partition paths as categories
+    return df
@@ -0,0 +1,68 @@
+"""
+This file creates synthetic IO-tables with the structure of the OECD files ({year}_SML.csv),
+so that the data preparation and the benchmarks can run without downloading the original data:
+a V1 column with the row labels (country_industry), one column per country and industry,
+six final demand columns per country (HFCE, NPISH, GGFC, GFCF, INVNT, DPABR), the output column OUT
+and the rows TLS (taxes), VA (value added) and OUT (output) at the end.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from prepare_icio import icio_countries, icio_industries
+
+final_demand = ['HFCE', 'NPISH', 'GGFC', 'GFCF', 'INVNT', 'DPABR']
+    # final demand categories in the order of the original files
+
+def icio_table(countries=icio_countries, industries=icio_industries, density=0.6, home_bias=20, seed=None):
+    # density: share of non-zero flows, home_bias: how much larger flows within a country are
+    rng = np.random.default_rng(seed)
+    n_countries, n_industries = len(countries), len(industries)
+    rows = [f'{c}_{i}' for c in countries for i in industries]
+    columns = rows + [f'{c}_{d}' for c in countries for d in final_demand]
+    column_country = np.concatenate([np.repeat(np.arange(n_countries), n_industries),
+                                     np.repeat(np.arange(n_countries), len(final_demand))])
+    column_scale = np.concatenate([np.ones(len(rows)), np.full(len(columns) - len(rows), n_industries / len(final_demand))])
+        # final demand columns as large as all industries together, so that value added is about half of output
+    inventories = np.flatnonzero(np.char.endswith(np.array(columns), '_INVNT'))
+    size = rng.lognormal(0, 1, n_countries)
+        # larger countries trade more with everyone
+
+    flows = np.empty((len(rows), len(columns)))
+    for c in range(n_countries):
+        # one block of rows per country keeps the temporary arrays small
+        block = rng.exponential(1.0, (n_industries, len(columns))) * size[c] * size[column_country] * column_scale
+        block[:, column_country == c] *= home_bias
+        block *= rng.random(block.shape) < density
+        block[:, inventories] *= rng.choice([-1, 1], (n_industries, len(inventories)))
+            # changes in inventories can be negative
+        flows[c * n_industries:(c + 1) * n_industries] = block
+    flows = np.round(flows * 100, 3)
+
+    output = flows.sum(axis=1)
+    taxes = np.round(0.05 * np.abs(flows).sum(axis=0), 3)
+    value_added = np.zeros(len(columns))
+    value_added[:len(rows)] = np.round(output - flows[:, :len(rows)].sum(axis=0) - taxes[:len(rows)], 3)
+        # value added closes the industry columns, so that output is the same by row and by column
+    column_total = flows.sum(axis=0) + taxes + value_added
+
+    table = np.zeros((len(rows) + 3, len(columns) + 1))
+    table[:len(rows), :len(columns)] = flows
+    table[:len(rows), -1] = output
+    table[len(rows):, :len(columns)] = [taxes, value_added, column_total]
+    data = pd.DataFrame(table, columns=columns + ['OUT'])
+    data.insert(0, 'V1', rows + ['TLS', 'VA', 'OUT'])
+    return data
+
+def write_icio(years, path, countries=icio_countries, industries=icio_industries, density=0.6, seed=0):
+    # one file per year (path as in prepare_icio, e.g. '../temp/benchmark/'), existing files are kept
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for year in years:
+        file = os.path.join(path, f'{year}_SML.csv')
+        if not os.path.exists(file):
+            icio_table(countries, industries, density, seed=[seed, year]).to_csv(file + '.tmp', index=False)
+            os.replace(file + '.tmp', file)
+        files.append(file)
+    return files
@@ -0,0 +1,145 @@
+"""
+This file keeps the IO-tables as a trade cube (country x industry x partner country x partner sector x year)
+and aggregates it on demand, so that other country groupings (EU, Euro area, a custom bloc, membership of a
+different year) or industry hierarchies do not require to collapse the csv files again.
+
+The cube of each year is stored once as a matrix (rows: country and industry, columns: partner country and sector)
+in ../temp/cube/ and memory-mapped when loaded. A roll-up multiplies it with aggregation matrices for the rows
+and the columns (see prepare_icio.aggregation_matrix) and returns a smaller cube, which can be rolled up again:
+    cube = build_cube(range(1995, 2021))
+    detail = rollup(cube, industry=industry_group)
+        # pre-aggregate once (industries as in collapse_row)
+    eu = cube_to_long(rollup(detail, country=zone_grouping('EU'), partner=zone_grouping('EU')), 'Sales')
+        # EU members of each year, all others as ROW
+"""
+
+import os, glob, json, hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from prepare_icio import cached_icio_to_dataframe, aggregation_matrix, file_hash, icio_dir, drop_columns, drop_rows
+from get_eu_euro_members import is_member, membership_intervals
+import instrument
+
+cube_dir = '../temp/cube/'
+
+# Build and load the cube:
+def build_cube(years, path=icio_dir, cube_dir=cube_dir, float32=False):
+    # the matrix of a year is only written if the csv file (or the drop rules) changed
+    years = list(years)
+    os.makedirs(cube_dir, exist_ok=True)
+    labels_key = hashlib.sha256('|'.join([drop_columns] + drop_rows).encode()).hexdigest()[:16]
+    labels_file = os.path.join(cube_dir, f'labels_{labels_key}.json')
+        # rows and columns depend on the drop rules, like the matrices
+    labels = None
+    if os.path.exists(labels_file):
+        with open(labels_file) as f:
+            labels = json.load(f)
+    values = []
+    for counter, year in enumerate(years, start=1):
+        file = f'{path}{year}_SML.csv'
+        key = hashlib.sha256('|'.join([file_hash(file), drop_columns, str(float32)] + drop_rows).encode()).hexdigest()[:16]
+        cube_file = os.path.join(cube_dir, f'{year}_{key}.npy')
+        if labels is None or not os.path.exists(cube_file):
+            # without the labels the stored matrices cannot be used
+            with instrument.stage('build cube', year):
+                data = cached_icio_to_dataframe(file)
+                year_labels = {'rows': data['V1'].tolist(),
+                               'columns': data.columns.drop(['V1', 'Country Code', 'Industry Code']).tolist()}
+                if labels is None:
+                    labels = year_labels
+                    with open(labels_file + '.tmp', 'w') as f:
+                        json.dump(labels, f)
+                    os.replace(labels_file + '.tmp', labels_file)
+                elif labels != year_labels:
+                    raise ValueError(f'The table of {year} has other rows or columns than the cube in {cube_dir}')
+                for old_file in glob.glob(os.path.join(cube_dir, f'{year}_*.npy')):
+                    os.remove(old_file)
+                np.save(cube_file + '.tmp.npy', np.nan_to_num(data[labels['columns']].to_numpy(dtype=np.float32 if float32 else float)))
+                os.replace(cube_file + '.tmp.npy', cube_file)
+            print(f"Data for {year} added to the cube (year {counter}/{len(years)})")
+        values.append(np.load(cube_file, mmap_mode='r'))
+            # memory-mapped: only the parts that are used are read from disk
+    return {'years': years, 'values': values,
+            'rows': pd.Index(labels['rows']).str.split('_', n=1, expand=True).set_names(['Country Code', 'Industry Code']),
+            'columns': pd.Index(labels['columns']).str.split('_', n=1, expand=True).set_names(['Trade Country Code', 'Trade Sector'])}
+
+# Groupings of the codes on one axis:
+#     None     keep the codes
+#     '*'      sum over all codes
+#     dict     code -> group (codes that are not in the dictionary are kept)
+#     function (codes, year) -> groups, e.g. membership in the year of the table
+def group_codes(codes, grouping, year):
+    if grouping is None:
+        return codes
+    if isinstance(grouping, str):
+        return pd.Index(np.full(len(codes), grouping, dtype=object))
+    position, uniques = pd.factorize(codes)
+        # the grouping is only applied to the distinct codes
+    if callable(grouping):
+        groups = grouping(uniques, year)
+    else:
+        groups = [grouping.get(code, code) for code in uniques]
+    return pd.Index(np.asarray(groups, dtype=object)[position])
+
+def industry_group(codes, year=None):
+    # industry hierarchy of collapse_row: manufacturing in detail (C...), all other industries by section
+    codes = pd.Index(codes)
+    return codes.where(codes.str[0] == 'C', codes.str[0])
+
+def zone_grouping(zone, year=None, other='ROW'):
+    # zone: 'EU'/'Euro' or a list of countries, year: membership of a fixed year instead of the year of each table
+    intervals = membership_intervals() if isinstance(zone, str) else None
+    def grouping(codes, table_year):
+        if isinstance(zone, str):
+            members = np.asarray(is_member(zone, codes, np.full(len(codes), year or table_year), intervals))
+        else:
+            members = pd.Index(codes).isin(zone)
+        return pd.Index(codes).where(members, other)
+    return grouping
+
+# Roll-ups:
+def axis_matrices(labels, first, second, years):
+    # aggregation matrix of every year onto the union of the groups of all years (groupings can change over time)
+    keys = [[group_codes(labels.get_level_values(0), first, year), group_codes(labels.get_level_values(1), second, year)]
+            for year in years]
+    groups = pd.MultiIndex.from_arrays([np.concatenate([k[0] for k in keys]), np.concatenate([k[1] for k in keys])]
+                                       ).unique().sort_values()
+    matrices = []
+    for first_groups, second_groups in keys:
+        matrix, year_groups = aggregation_matrix([first_groups, second_groups])
+        placement = sparse.csr_matrix((np.ones(len(year_groups)), (groups.get_indexer(year_groups), np.arange(len(year_groups)))),
+                                      shape=(len(groups), len(year_groups)))
+        matrices.append(placement @ matrix)
+            # groups of the year placed in the union (groups missing in a year stay zero)
+    return matrices, groups.set_names(labels.names)
+
+def rollup(cube, country=None, industry=None, partner=None, sector=None, years=None):
+    # aggregate the cube (see the groupings above), the result is a cube again
+    years = cube['years'] if years is None else list(years)
+    positions = [cube['years'].index(year) for year in years]
+    row_matrices, rows = axis_matrices(cube['rows'], country, industry, years)
+    col_matrices, columns = axis_matrices(cube['columns'], partner, sector, years)
+    values = []
+    with instrument.stage('rollup') as record:
+        for position, row_matrix, col_matrix in zip(positions, row_matrices, col_matrices):
+            values.append(np.asarray(col_matrix @ (row_matrix @ cube['values'][position]).T).T)
+                # rows are aggregated first, which makes the second product small
+        record['rows'] = len(rows) * len(columns) * len(years)
+    return {'years': years, 'values': values, 'rows': rows, 'columns': columns}
+
+def cube_to_long(cube, var, nonzero=False):
+    # long format as in collapse_row (same column order and sorting)
+    frames = []
+    for year, values in zip(cube['years'], cube['values']):
+        n_rows, n_cols = values.shape
+        df = pd.DataFrame({
+            'Country Code': np.repeat(cube['rows'].get_level_values(0), n_cols),
+            'Industry Code': np.repeat(cube['rows'].get_level_values(1), n_cols),
+            'Trade Country Code': np.tile(cube['columns'].get_level_values(0), n_rows),
+            'Trade Sector': np.tile(cube['columns'].get_level_values(1), n_rows),
+            'Year': year,
+            var: np.asarray(values).ravel()})
+        frames.append(df[df[var] != 0] if nonzero else df)
+    return pd.concat(frames, ignore_index=True)
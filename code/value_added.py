@@ -0,0 +1,123 @@
+"""
+The functions in this file decompose the gross exports of every country and industry into domestic
+and foreign value added (value added in trade), using the Leontief inverse of the IO-table of each year.
+
+With the technical coefficients A = Z / x and the value added coefficients v = VA / x, the value added
+of country s contained in one unit of output of industry j is W[j, s] = sum of v[i] * L[i, j] over the
+industries i of s, with L = (I - A)^-1. Instead of inverting I - A, its LU factorization is used to solve
+(I - A)' W = V for all countries at once (V: value added coefficients masked by country).
+The factorizations are cached on disk (keyed by the content of the csv file), so a repeated decomposition
+of a year only needs the triangular solves.
+"""
+
+import os, glob, hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import linalg
+
+from prepare_icio import icio_dir, file_hash
+import instrument
+
+factor_cache_dir = '../temp/leontief_cache/'
+cache_version = 1
+    # part of the cache key, increase it when the stored arrays change
+
+def icio_matrices(file):
+    # intermediate flows Z (n x n), exports to each destination country (n x countries), value added and output (n)
+    table = pd.read_csv(file, index_col=0)
+    rows = table.index.drop(['TLS', 'VA', 'OUT'])
+    labels = rows.str.split('_', n=1, expand=True)
+    countries = pd.Index(labels.get_level_values(0).unique())
+    row_country = countries.get_indexer(labels.get_level_values(0))
+
+    output = table.loc[rows, 'OUT'].to_numpy(dtype=float)
+    value_added = table.loc['VA', rows].to_numpy(dtype=float)
+    flows = table.loc[rows].drop(columns='OUT')
+    z = flows[rows].to_numpy(dtype=float)
+        # columns of the industries in the same order as the rows
+    column_country = countries.get_indexer(flows.columns.str.split('_', n=1).str[0])
+    destination = np.zeros((len(flows.columns), len(countries)))
+    destination[np.arange(len(flows.columns)), column_country] = 1
+    exports = np.nan_to_num(flows.to_numpy(dtype=float)) @ destination
+        # intermediate and final use (all final demand categories) by destination country
+    exports[np.arange(len(rows)), row_country] = 0
+        # sales within the own country are not exports
+    return z, exports, value_added, output, labels, countries, row_country
+
+def leontief_factors(z, output):
+    # LU factorization of I - A (industries without output get a zero column in A)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = np.where(output > 0, np.nan_to_num(z) / output, 0)
+    return linalg.lu_factor(np.eye(len(output)) - a, overwrite_a=True, check_finite=False)
+
+def cached_factors(file, cache_dir=factor_cache_dir):
+    # all arrays needed for the decomposition of a year, the csv file is only parsed on a cache miss
+    key = hashlib.sha256(f'{file_hash(file)}|{cache_version}'.encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(file))[0]
+    cache_file = os.path.join(cache_dir, f'{name}_{key}.npz')
+    if os.path.exists(cache_file):
+        with instrument.stage('read factors'), np.load(cache_file, allow_pickle=False) as cached:
+            return {k: cached[k] for k in cached.files}
+
+    with instrument.stage('read table'):
+        z, exports, value_added, output, labels, countries, row_country = icio_matrices(file)
+    with instrument.stage('lu_factor') as record:
+        lu, piv = leontief_factors(z, output)
+        record['rows'] = len(output)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        va_coefficients = np.where(output > 0, np.nan_to_num(value_added) / output, 0)
+    factors = {'lu': lu, 'piv': piv, 'va_coefficients': va_coefficients, 'exports': exports,
+               'country': labels.get_level_values(0).to_numpy(str), 'industry': labels.get_level_values(1).to_numpy(str),
+               'countries': countries.to_numpy(str), 'row_country': row_country}
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_file in glob.glob(os.path.join(cache_dir, f'{name}_*.npz')):
+        os.remove(old_file)
+        # remove outdated versions of the same year
+    np.savez(cache_file + '.tmp.npz', **factors)
+    os.replace(cache_file + '.tmp.npz', cache_file)
+    return factors
+
+def va_by_origin(factors):
+    # W[j, s]: value added of country s in one unit of output of industry j (one solve with all countries as right-hand sides)
+    n, n_countries = len(factors['row_country']), len(factors['countries'])
+    masked = np.zeros((n, n_countries))
+    masked[np.arange(n), factors['row_country']] = factors['va_coefficients']
+    with instrument.stage('lu_solve') as record:
+        record['rows'] = n
+        return linalg.lu_solve((factors['lu'], factors['piv']), masked, trans=1, check_finite=False)
+
+def decompose_year(year,path=icio_dir,by_source=False,cache_dir=factor_cache_dir):
+    # domestic (DVA) and foreign (FVA) value added in the exports of every country and industry,
+    # by_source: value added of every source country instead (long format)
+    with instrument.stage('decompose_year', year):
+        factors = cached_factors(f'{path}{year}_SML.csv', cache_dir)
+        va_content = va_by_origin(factors)
+        gross_exports = factors['exports'].sum(axis=1)
+        rows = np.arange(len(gross_exports))
+        if by_source:
+            return pd.DataFrame({
+                'Country Code': np.repeat(factors['country'], len(factors['countries'])),
+                'Industry Code': np.repeat(factors['industry'], len(factors['countries'])),
+                'Source Country Code': np.tile(factors['countries'], len(rows)),
+                'Year': year,
+                'Value Added': (va_content * gross_exports[:, None]).ravel()})
+        domestic = va_content[rows, factors['row_country']] * gross_exports
+        return pd.DataFrame({'Country Code': factors['country'], 'Industry Code': factors['industry'], 'Year': year,
+                             'Exports': gross_exports, 'DVA': domestic,
+                             'FVA': va_content.sum(axis=1) * gross_exports - domestic})
+
+def decompose_years(years,path=icio_dir,by_source=False,cache_dir=factor_cache_dir,max_workers=1):
+    # max_workers > 1 (or None for all cores): several years at the same time in separate processes
+    years = list(years)
+    if max_workers == 1:
+        results = (decompose_year(year,path,by_source,cache_dir) for year in years)
+        return pd.concat(list(print_progress(years, results)), ignore_index=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(decompose_year, years, [path] * len(years), [by_source] * len(years), [cache_dir] * len(years))
+        return pd.concat(list(print_progress(years, results)), ignore_index=True)
+
+def print_progress(years, results):
+    for counter, (year, df) in enumerate(zip(years, results), start=1):
+        print(f"Data for {year} decomposed (year {counter}/{len(years)})")
+        yield df